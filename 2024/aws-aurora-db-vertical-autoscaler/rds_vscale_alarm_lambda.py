@@ -1,50 +1,16 @@
 import json
-import os
-import random
-import re
-from datetime import datetime, timezone, timedelta
 from botocore.exceptions import ClientError
-import boto3
+from rds_vscale_core import (
+    get_client, send_sns_alert, instance_type_sorter, get_instance_details, any_member_modifying,
+    add_modifying_tag, instrumented, record_decision, get_cluster_config,
+    replica_identifier_prefix, new_replica_identifier, create_reader_replica, delete_reader_replica,
+    least_loaded_instance, any_instance_has_modifying_tag, modification_timestamps, find_failover_target,
+    cluster_is_busy
+)
+from rds_vscale_decision import detect_bottleneck, choose_target_class
+from rds_vscale_lock import get_lock_store, acquire_scaling_lock, mark_modifying, start_resize, start_failover
 
 
-size_order_str = os.environ.get("SIZE_ORDER", "[]")
-SIZE_ORDER = json.loads(size_order_str)
-MODIFY_COOLDOWN_PERIOD = int(os.environ.get("MODIFY_COOLDOWN_PERIOD", "900"))
-MODIFYING_STATUSES = ["modifying", "storage-optimization", "creating", "rebooting"]
-
-rds_client = boto3.client('rds')
-sns_client = boto3.client('sns')
-sns_topic_arn = os.environ.get('ALARMS_SNS')
-
-def send_sns_alert(message):
-    """
-    SNS alerting
-    """
-    try:
-        sns_client.publish(
-            TopicArn=sns_topic_arn,
-            Message=message
-        )
-        print(f"SNS alert sent. Message: {message}")
-    except ClientError as e:
-        print(f"Failed to send SNS alert. Error: {e}")
-
-def get_instance_details(client, instance_identifier):
-    """
-    get the instance details
-    """
-    try:
-        response = client.describe_db_instances(DBInstanceIdentifier=instance_identifier)
-        instance_info = response['DBInstances'][0]
-        instance_class = instance_info['DBInstanceClass']
-        cluster_identifier = instance_info.get('DBClusterIdentifier', None)
-        return instance_class, cluster_identifier
-    except ClientError as e:
-        error_message = f"Error getting the DB instance details: {e}"
-        print(error_message)
-        send_sns_alert(error_message)
-        return None, None
-
 def get_cluster_version(client, cluster_identifier):
     """
     get the cluster version
@@ -60,132 +26,139 @@ def get_cluster_version(client, cluster_identifier):
         return None
 
 
-
-def instance_type_sorter(instance_type):
+def add_reader_replica(client, lock_store, cluster_identifier, cluster_instances, instance_class, cluster_config):
     """
-    instance type sorter
+    add a reader of the largest class once the readers can't be scaled up any more (up to the max_readers readers)
     """
-    return SIZE_ORDER.index(instance_type) if instance_type in SIZE_ORDER else -1
-
-
-def change_instance_type(client, instance_identifier, new_instance_type):
+    readers = [member['DBInstanceIdentifier'] for member in cluster_instances if not member['IsClusterWriter']]
+    if len(readers) >= cluster_config['max_readers']:
+        return False
+    instance_identifier = new_replica_identifier(cluster_identifier)
+    if lock_store and not acquire_scaling_lock(lock_store, cluster_identifier, instance_identifier):
+        return True
+    source_identifier = readers[0] if readers else cluster_instances[0]['DBInstanceIdentifier']
+    print(f"Attempting to add the reader instance {instance_identifier} of the type {instance_class}")
+    _, error = create_reader_replica(client, cluster_identifier, instance_identifier, source_identifier, instance_class)
+    mark_modifying(client, lock_store, cluster_identifier, instance_identifier, instance_identifier,
+                   not error, cluster_config['cooldown'])
+    if not error:
+        message = f"Added the reader instance {instance_identifier} of the type {instance_class}"
+        print(message)
+        send_sns_alert(message)
+        record_decision("reader-added", instance_class, instance_class,
+                        ClusterIdentifier=cluster_identifier, InstanceIdentifier=instance_identifier)
+    else:
+        record_decision("failed", instance_class, instance_class,
+                        ClusterIdentifier=cluster_identifier, InstanceIdentifier=instance_identifier)
+    return True
+
+
+def remove_reader_replica(client, lock_store, cluster_identifier, cluster_instances, cluster_config):
     """
-    change the instance type
+    delete the newest reader added by the horizontal scaling once the alarm is back to OK
     """
-    try:
-        response = client.modify_db_instance(
-            DBInstanceIdentifier=instance_identifier,
-            DBInstanceClass=new_instance_type,
-            ApplyImmediately=True
-        )
-        return response, None
-    except ClientError as e:
-        error_message = f"Error during an attempt to vertically scale the RDS instance {e}"
-        print(error_message)
-        send_sns_alert(error_message)
-        return None, str(e)
-
-def get_instance_arn(client, instance_identifier):
+    prefix = replica_identifier_prefix(cluster_identifier)
+    replicas = sorted((member['DBInstanceIdentifier'] for member in cluster_instances
+                       if not member['IsClusterWriter'] and member['DBInstanceIdentifier'].startswith(prefix)),
+                      reverse=True)
+    if not replicas:
+        print("No added reader instances to remove.")
+        record_decision("no-action", ClusterIdentifier=cluster_identifier)
+        return
+    if cluster_is_busy([member['DBInstanceIdentifier'] for member in cluster_instances]):
+        # The OK state may be the alarm of one instance only while the others are still loaded
+        print("The cluster is busy, not removing a reader yet.")
+        record_decision("load-skipped", ClusterIdentifier=cluster_identifier)
+        return
+    instance_identifier = replicas[0]
+    if lock_store and not acquire_scaling_lock(lock_store, cluster_identifier, instance_identifier):
+        return
+    print(f"Attempting to delete the reader instance {instance_identifier}")
+    instance_class, _ = get_instance_details(client, instance_identifier)
+    _, error = delete_reader_replica(client, instance_identifier)
+    # The deleting status keeps the other invocations off, so the instance isn't tagged
+    mark_modifying(client, lock_store, cluster_identifier, instance_identifier, None,
+                   not error, cluster_config['cooldown'])
+    if lock_store is None and not error:
+        # The tags go away with the instance: the cooldown is timed from a timestamp on the writer instead
+        writer_identifier = next((member['DBInstanceIdentifier'] for member in cluster_instances
+                                  if member['IsClusterWriter']), None)
+        if writer_identifier:
+            add_modifying_tag(client, writer_identifier, modifying=False)
+    if not error:
+        message = f"Deleted the reader instance {instance_identifier}"
+        print(message)
+        send_sns_alert(message)
+        record_decision("reader-removed", instance_class, ClusterIdentifier=cluster_identifier,
+                        InstanceIdentifier=instance_identifier)
+    else:
+        record_decision("failed", instance_class, ClusterIdentifier=cluster_identifier,
+                        InstanceIdentifier=instance_identifier)
+
+
+def scale_up_instance(client, lock_store, cluster_identifier, instance_identifier, role, instance_class,
+                      new_instance_class, cluster_config, **properties):
     """
-    get the instance arn
+    change the instance type of the reader or the writer
     """
-    try:
-        instance_info = client.describe_db_instances(DBInstanceIdentifier=instance_identifier)
-        return instance_info['DBInstances'][0]['DBInstanceArn']
-    except ClientError as e:
-        error_message = f"Error getting the instance ARN for {instance_identifier}: {e}"
+    acquired, error = start_resize(client, lock_store, cluster_identifier, instance_identifier, new_instance_class,
+                                   cluster_config['cooldown'])
+    if not acquired:
+        return
+    if not error:
+        message = f"Changed the {role} instance type to {new_instance_class}"
+        print(message)
+        send_sns_alert(message)
+        record_decision(f"{role}-up", instance_class, new_instance_class,
+                        ClusterIdentifier=cluster_identifier, InstanceIdentifier=instance_identifier, **properties)
+    else:
+        record_decision("failed", instance_class, new_instance_class,
+                        ClusterIdentifier=cluster_identifier, InstanceIdentifier=instance_identifier)
+        error_message = f"Failed to change the {role} instance type. Error: {error}"
         print(error_message)
         send_sns_alert(error_message)
-        return None
 
 
-def add_modifying_tag(client, instance_identifier):
+def fail_over_writer(client, lock_store, cluster_identifier, writer_identifier, instance_class, target_identifier,
+                     new_instance_class, cluster_config, **properties):
     """
-    add the modifying tag and timestamp to prevent simultaneous actions at the same time
+    promote the reader of the new writer size; the old writer is brought to size by the event lambda
     """
-    instance_arn = get_instance_arn(client, instance_identifier)
-    if not instance_arn:
-        print(f"ARN not found for the instance {instance_identifier}")
+    acquired, error = start_failover(client, lock_store, cluster_identifier, writer_identifier, target_identifier,
+                                     cluster_config['cooldown'])
+    if not acquired:
         return
-    timestamp = datetime.now(timezone.utc).isoformat()
-    try:
-        client.add_tags_to_resource(
-            ResourceName=instance_arn,
-            Tags=[{'Key': 'modifying', 'Value': 'true'},
-                  {'Key': 'modificationTimestamp', 'Value': timestamp}
-                  ]
-        )
-        print(f"Added the 'modifying' tag to instance {instance_identifier}")
-    except ClientError as e:
-        error_message = f"Error adding the 'modifying' tag to {instance_identifier}: {e}"
+    if not error:
+        message = f"Failed over the writer role from {writer_identifier} to {target_identifier}"
+        print(message)
+        send_sns_alert(message)
+        record_decision("writer-up", instance_class, new_instance_class, ClusterIdentifier=cluster_identifier,
+                        InstanceIdentifier=target_identifier, Strategy="failover", **properties)
+    else:
+        record_decision("failed", instance_class, new_instance_class,
+                        ClusterIdentifier=cluster_identifier, InstanceIdentifier=target_identifier)
+        error_message = f"Failed to fail over the writer instance. Error: {error}"
         print(error_message)
         send_sns_alert(error_message)
 
-def any_instance_has_modifying_tag(client, cluster_instances):
-    """
-    check if the modifying tag exists
-    """
-    for member in cluster_instances:
-        instance_arn = get_instance_arn(client, member['DBInstanceIdentifier'])
-        tags = rds_client.list_tags_for_resource(ResourceName=instance_arn)['TagList']
-        if any(tag['Key'] == 'modifying' for tag in tags):
-            return True
-    return False
-
-
-def modification_timestamps(client, cluster_instances, cooldown_period):
-    """
-    modification timestamps workflow
-    """
-    now = datetime.now(timezone.utc)
-    expired_instances = []
-    cooldown_not_expired = False
-
-    for member in cluster_instances:
-        instance_identifier = member['DBInstanceIdentifier']
-        instance_arn = get_instance_arn(client, instance_identifier)
-        tags = client.list_tags_for_resource(ResourceName=instance_arn)['TagList']
-
-        for tag in tags:
-            if tag['Key'] == 'modificationTimestamp':
-                tag_timestamp = datetime.fromisoformat(tag['Value'])
-                time_diff_seconds = (now - tag_timestamp).total_seconds()
-                cooldown_seconds = timedelta(seconds=cooldown_period).total_seconds()
-
-                if time_diff_seconds >= cooldown_seconds:
-                    expired_instances.append(instance_identifier)
-                else:
-                    cooldown_not_expired = True
-
-    for instance_identifier in expired_instances:
-        instance_arn = get_instance_arn(rds_client, instance_identifier)
-        rds_client.remove_tags_from_resource(
-            ResourceName=instance_arn,
-            TagKeys=['modificationTimestamp']
-        )
-
-    return cooldown_not_expired
-
-
-def any_member_modifying(client, cluster_instances):
-    """
-    checking if any cluster instance is being modified already
-    """
-    for member in cluster_instances:
-        instance_info = client.describe_db_instances(DBInstanceIdentifier=member['DBInstanceIdentifier'])
-        if instance_info['DBInstances'][0]['DBInstanceStatus'] in MODIFYING_STATUSES:
-            return True
-    return False
-
 
+@instrumented("alarm")
 def lambda_handler(event, _):
     """
     lambda function triggered by alarm
     """
     print("Received event: " + json.dumps(event, indent=2))
+    rds_client = get_client('rds')
+    lock_store = get_lock_store()
     try:
         for record in event['Records']:
             sns_message = json.loads(record['Sns']['Message'])
+            alarm_state = sns_message.get('NewStateValue', 'ALARM')
+            if alarm_state not in ('ALARM', 'OK'):
+                # E.g. INSUFFICIENT_DATA: neither a reason to scale up nor to scale in
+                print(f"Ignoring the {alarm_state} state of the alarm")
+                record_decision("ignored")
+                continue
             db_instance_identifier = None
             for dimension in sns_message['Trigger']['Dimensions']:
                 if dimension['name'] == 'DBInstanceIdentifier':
@@ -195,15 +168,31 @@ def lambda_handler(event, _):
             if db_instance_identifier is None:
                 raise ValueError("DBInstanceIdentifier not found in the CloudWatch Alarm event")
 
-            _, cluster_identifier = get_instance_details(rds_client, db_instance_identifier)
+            alarm_instance_type, cluster_identifier = get_instance_details(rds_client, db_instance_identifier)
             if not cluster_identifier:
                 raise ValueError("Instance is not a part of any RDS cluster")
 
+            cluster_config = get_cluster_config(cluster_identifier)
+            if cluster_config is None:
+                print(f"Ignoring the alarm for cluster: {cluster_identifier}")
+                record_decision("ignored", ClusterIdentifier=cluster_identifier)
+                continue
+            if alarm_state == 'OK' and not cluster_config['max_readers']:
+                # Without the horizontal scaling there is nothing to scale in
+                print(f"Ignoring the OK state of the alarm for cluster: {cluster_identifier}")
+                record_decision("ignored", ClusterIdentifier=cluster_identifier)
+                continue
+            size_order = cluster_config['size_order']
+            max_size_index = len(size_order) - 1
+            if cluster_config.get('max_instance_class'):
+                max_size_index = size_order.index(cluster_config['max_instance_class'])
+
             cluster_response = rds_client.describe_db_clusters(DBClusterIdentifier=cluster_identifier)
             cluster_instances = cluster_response['DBClusters'][0]['DBClusterMembers']
 
             if any_member_modifying(rds_client, cluster_instances):
                 print("At least one instance in the cluster is currently being modified.")
+                record_decision("modifying-skipped", ClusterIdentifier=cluster_identifier)
                 return
 
             writer_instance_identifier, writer_instance_type = None, None
@@ -213,14 +202,14 @@ def lambda_handler(event, _):
                     writer_instance_type, _ = get_instance_details(rds_client, writer_instance_identifier)
 
             if writer_instance_type:
-                writer_size_index = SIZE_ORDER.index(writer_instance_type)
+                writer_size_index = size_order.index(writer_instance_type)
 
                 is_writer_smallest = True
                 for member in cluster_instances:
                     member_instance_type, _ = get_instance_details(rds_client, member['DBInstanceIdentifier'])
                     if member['DBInstanceIdentifier'] == writer_instance_identifier:
                         continue
-                    member_size_index = SIZE_ORDER.index(member_instance_type)
+                    member_size_index = size_order.index(member_instance_type)
 
                     if member_size_index < writer_size_index:
                         is_writer_smallest = False
@@ -231,42 +220,77 @@ def lambda_handler(event, _):
                 raise ValueError("The writer instance type not found in the cluster")
 
 
+            reader_instance_types = set()
             for member in cluster_instances:
                 if not member['IsClusterWriter']:
                     member_instance_type, _ = get_instance_details(rds_client, member['DBInstanceIdentifier'])
-                    if instance_type_sorter(member_instance_type) <= instance_type_sorter(writer_instance_type):
+                    reader_instance_types.add(member_instance_type)
+                    if instance_type_sorter(member_instance_type, size_order) <= instance_type_sorter(writer_instance_type, size_order):
                         is_writer_smallest = False
 
             # Check if any instance is being modified or has the modifying tag
-            if any_instance_has_modifying_tag(rds_client, cluster_instances):
+            # (with the lock store, the lock is taken right before the modification instead)
+            if lock_store is None and any_instance_has_modifying_tag(rds_client, cluster_instances):
                 print("An instance in the cluster has the 'modifying' tag.")
+                record_decision("modifying-skipped", ClusterIdentifier=cluster_identifier)
                 return
 
-            cooldown_not_expired = modification_timestamps(rds_client, cluster_instances, MODIFY_COOLDOWN_PERIOD)
+            cooldown_not_expired = lock_store is None and modification_timestamps(rds_client, cluster_instances, cluster_config['cooldown'])
             if cooldown_not_expired:
                 message = "We tried to vertically scale the RDS instance in the cluster. However, the Cooldown period has not expired for at least one instance in the cluster."
                 print(message)
                 print(send_sns_alert)
+                record_decision("cooldown-skipped", ClusterIdentifier=cluster_identifier)
                 return
 
+            if alarm_state == 'OK':
+                # The load has subsided: remove a surplus reader
+                remove_reader_replica(rds_client, lock_store, cluster_identifier, cluster_instances, cluster_config)
+                continue
+
+            # What limits the instance decides the class to scale up to
+            bottleneck = detect_bottleneck(db_instance_identifier, alarm_instance_type,
+                                           cluster_response['DBClusters'][0]['Engine'],
+                                           sns_message['Trigger'].get('MetricName'))
+
             if is_writer_smallest:
                 # Scaling up the writer
-                new_writer_instance_type = SIZE_ORDER[writer_size_index + 1]
+                # With the failover strategy, a class of the readers is taken if it relieves the writer too
+                preferred = reader_instance_types if cluster_config['writer_scale_strategy'] == "failover" else None
+                new_writer_instance_type = choose_target_class(writer_instance_type, bottleneck, size_order, max_size_index,
+                                                               preferred)
                 print(f"Selected new instance type for the writer: {new_writer_instance_type}")
-                if new_writer_instance_type != writer_instance_type:
-                    print(f"Attempting to change the instance type for {writer_instance_identifier} to {new_writer_instance_type}")
-                    _, error = change_instance_type(rds_client, writer_instance_identifier, new_writer_instance_type)
-                    if not error:
-                        message = f"Changed the writer instance type to {new_writer_instance_type}"
+                failover_target, readers = None, []
+                writer_strategy = "modify"
+                if cluster_config['writer_scale_strategy'] == "failover" and new_writer_instance_type != writer_instance_type:
+                    failover_target = find_failover_target(rds_client, cluster_instances, new_writer_instance_type, size_order)
+                    readers = [member['DBInstanceIdentifier'] for member in cluster_instances if not member['IsClusterWriter']]
+                    writer_strategy = "failover" if failover_target or readers else "modify-fallback"
+                if failover_target:
+                    fail_over_writer(rds_client, lock_store, cluster_identifier, writer_instance_identifier,
+                                     writer_instance_type, failover_target['DBInstanceIdentifier'], new_writer_instance_type,
+                                     cluster_config, Bottleneck=bottleneck)
+                elif readers:
+                    # No reader is of the new size yet: one is resized first, and the event lambda fails over to it
+                    reader_to_scale = least_loaded_instance(readers)
+                    reader_instance_type, _ = get_instance_details(rds_client, reader_to_scale)
+                    print(f"No reader of the type {new_writer_instance_type} to fail over to, scaling up {reader_to_scale} first")
+                    scale_up_instance(rds_client, lock_store, cluster_identifier, reader_to_scale, "reader",
+                                      reader_instance_type, new_writer_instance_type, cluster_config,
+                                      Strategy=writer_strategy, Bottleneck=bottleneck)
+                elif new_writer_instance_type != writer_instance_type:
+                    if writer_strategy == "modify-fallback":
+                        message = (f"There is no reader to fail over to in the cluster {cluster_identifier}, "
+                                   f"the writer instance {writer_instance_identifier} is resized in place")
                         print(message)
                         send_sns_alert(message)
-                        add_modifying_tag(rds_client, writer_instance_identifier)
-                    else:
-                        error_message = f"Failed to change the writer instance type. Error: {error}"
-                        print(error_message)
-                        send_sns_alert(error_message)
-                else:
+                    scale_up_instance(rds_client, lock_store, cluster_identifier, writer_instance_identifier, "writer",
+                                      writer_instance_type, new_writer_instance_type, cluster_config,
+                                      Strategy=writer_strategy, Bottleneck=bottleneck)
+                elif not add_reader_replica(rds_client, lock_store, cluster_identifier, cluster_instances,
+                                            writer_instance_type, cluster_config):
                     error_message = "The writer instance is at the maximum size already; scaling is not possible"
+                    record_decision("max-size", writer_instance_type, ClusterIdentifier=cluster_identifier)
                     print(error_message)
                     send_sns_alert(error_message)
                 continue
@@ -278,7 +302,7 @@ def lambda_handler(event, _):
             for member in cluster_instances:
                 if not member['IsClusterWriter']:
                     member_instance_type, _ = get_instance_details(rds_client, member['DBInstanceIdentifier'])
-                    member_index = SIZE_ORDER.index(member_instance_type)
+                    member_index = size_order.index(member_instance_type)
                     if member_index < min_size_index:
                         min_size_index = member_index
                         eligible_readers = [member['DBInstanceIdentifier']]
@@ -286,27 +310,23 @@ def lambda_handler(event, _):
                         eligible_readers.append(member['DBInstanceIdentifier'])
 
 
-            if eligible_readers and min_size_index < len(SIZE_ORDER) - 1:
-                reader_to_scale = random.choice(eligible_readers)
-                new_reader_instance_type = SIZE_ORDER[min_size_index + 1]
+            if eligible_readers and min_size_index < max_size_index:
+                reader_to_scale = least_loaded_instance(eligible_readers)
+                new_reader_instance_type = choose_target_class(size_order[min_size_index], bottleneck, size_order, max_size_index)
                 if new_reader_instance_type != smallest_size:
-                    print(f"Attempting to change the instance type for {reader_to_scale} to {new_reader_instance_type}")
-                    _, error = change_instance_type(rds_client, reader_to_scale, new_reader_instance_type)
-                    if not error:
-                        message = f"Changed the reader instance type to {new_reader_instance_type}"
-                        print(message)
-                        send_sns_alert(message)
-                        add_modifying_tag(rds_client, reader_to_scale)
-                    else:
-                        error_message = f"Failed to change the reader instance type. Error: {error}"
-                        print(error_message)
-                        send_sns_alert(error_message)
+                    scale_up_instance(rds_client, lock_store, cluster_identifier, reader_to_scale, "reader",
+                                      size_order[min_size_index], new_reader_instance_type, cluster_config,
+                                      Bottleneck=bottleneck)
                 else:
                     error_message = "The reader instance is at the maximum size already; scaling is not possible"
+                    record_decision("max-size", size_order[min_size_index], ClusterIdentifier=cluster_identifier)
                     print(error_message)
                     send_sns_alert(error_message)
-            else:
+            # The readers are of the largest class already: scale out instead if allowed
+            elif not (eligible_readers and add_reader_replica(rds_client, lock_store, cluster_identifier, cluster_instances,
+                                                              size_order[min_size_index], cluster_config)):
                 print("No eligible readers to scale up.")
+                record_decision("no-action", ClusterIdentifier=cluster_identifier)
                 send_sns_alert("We tried to vertically scale the RDS instance. However, the required conditions were not met.")
 
         return {
@@ -314,6 +334,7 @@ def lambda_handler(event, _):
             'body': json.dumps("Processed instances in the cluster.")
         }
     except ClientError as e:
+        record_decision("failed")
         error_message = f"Failed to execute the function. Error: {str(e)}"
         print(error_message)
         send_sns_alert(error_message)
@@ -0,0 +1,731 @@
+"""
+Replays scripted CloudWatch alarm, schedule and RDS event sequences against the lambdas
+using the fake backend from rds_vscale_sim.py.
+
+For every scenario it reports the API calls made by each invocation, its wall time
+and the action it took (as read from the EMF metrics the lambdas print),
+the (simulated) time the cluster took to converge, the write downtime and any
+invariant violations, e.g. two members of a cluster being modified at the same time.
+The outcome is compared with the 'expect' block of the scenario: the actions taken
+(all of them, or only the 'changes' made), the classes of the members at given times
+and in the end, and the write downtime.
+
+Usage: python rds_vscale_bench.py [--scenario NAME] [--json] [--verbose]
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from unittest import mock
+
+import rds_vscale_sim as sim
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZE_ORDER = ["db.r6g.large", "db.r6g.xlarge", "db.r6g.2xlarge", "db.r6g.4xlarge"]
+MIXED_SIZE_ORDER = ["db.r6g.large", "db.x2g.large", "db.r6g.xlarge", "db.x2g.xlarge", "db.r6g.2xlarge", "db.x2g.2xlarge"]
+EVENT_DELIVERY_DELAY = 5
+MAX_INVOCATIONS = 200
+# The alarm states of the script kinds
+ALARM_STATES = {'alarm': 'ALARM', 'ok': 'OK', 'insufficient-data': 'INSUFFICIENT_DATA'}
+# The actions which change the cluster (the 'changes' of the expectations)
+CHANGE_SUFFIXES = ('-up', '-down', '-added', '-removed')
+DEFAULT_ENV = {
+    'SIZE_ORDER': json.dumps(SIZE_ORDER),
+    'MODIFY_COOLDOWN_PERIOD': '900',
+    'ALARMS_SNS': 'arn:aws:sns:eu-central-1:123456789012:rds-vscale-alarms',
+    'CLUSTER_NAME': 'aurora',
+    'AWS_DEFAULT_REGION': 'eu-central-1',
+}
+
+SCENARIOS = [
+    {
+        'name': 'reader-scale-up',
+        'description': 'one alarm, readers are the smallest; the event lambda brings the rest to the same size',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        'script': [(0, 'alarm', ['aurora-instance-1'])],
+        'expect': {'changes': ['reader-up', 'writer-up aurora-instance-1', 'reader-up'],
+                   'final_classes': 'db.r6g.xlarge', 'write_downtime_s': 600},
+    },
+    {
+        'name': 'writer-scale-up-modify',
+        'description': 'one alarm, the writer is the smallest and is resized in place',
+        'cluster': ('db.r6g.large', ['db.r6g.xlarge', 'db.r6g.xlarge']),
+        'script': [(0, 'alarm', ['aurora-instance-1'])],
+        'env': {'WRITER_SCALE_STRATEGY': 'modify'},
+        'expect': {'actions': ['writer-up aurora-instance-1', 'completed'],
+                   'final_classes': 'db.r6g.xlarge', 'write_downtime_s': 600},
+    },
+    {
+        'name': 'writer-scale-up-failover',
+        'description': 'one alarm, the writer is the smallest and a bigger reader is promoted',
+        'cluster': ('db.r6g.large', ['db.r6g.xlarge', 'db.r6g.xlarge']),
+        'script': [(0, 'alarm', ['aurora-instance-1'])],
+        'env': {'WRITER_SCALE_STRATEGY': 'failover'},
+        'expect': {'actions': ['writer-up aurora-instance-2', 'reader-up aurora-instance-1', 'completed'],
+                   'final_classes': 'db.r6g.xlarge', 'write_downtime_s': 30},
+    },
+    {
+        'name': 'writer-scale-up-failover-reader-first',
+        'description': 'writer-scale-up-failover with the CPU bound writer and only memory optimized readers of its size; '
+                       'a reader is resized to the target class before the failover',
+        'cluster': ('db.r6g.large', ['db.x2g.large', 'db.x2g.large']),
+        'script': [(0, 'alarm', ['aurora-instance-1'])],
+        'metrics': {
+            'aurora-instance-1': {'CPUUtilization': 92.0, 'FreeableMemory': 6.0 * 1024 ** 3,
+                                  'BufferCacheHitRatio': 99.5, 'DatabaseConnections': 120},
+        },
+        'env': {'WRITER_SCALE_STRATEGY': 'failover', 'SIZE_ORDER': json.dumps(MIXED_SIZE_ORDER)},
+        'expect': {'changes': ['reader-up', 'writer-up', 'reader-up aurora-instance-1', 'reader-up'],
+                   'final_classes': 'db.r6g.xlarge', 'write_downtime_s': 30},
+    },
+    {
+        'name': 'writer-scale-up-failover-reader-class',
+        'description': 'writer-scale-up-failover-reader-first with a bigger memory optimized reader; '
+                       'its class relieves the CPU as well and is taken as the target',
+        'cluster': ('db.r6g.large', ['db.x2g.large', 'db.x2g.xlarge']),
+        'script': [(0, 'alarm', ['aurora-instance-1'])],
+        'metrics': {
+            'aurora-instance-1': {'CPUUtilization': 92.0, 'FreeableMemory': 6.0 * 1024 ** 3,
+                                  'BufferCacheHitRatio': 99.5, 'DatabaseConnections': 120},
+        },
+        'env': {'WRITER_SCALE_STRATEGY': 'failover', 'SIZE_ORDER': json.dumps(MIXED_SIZE_ORDER)},
+        'expect': {'actions': ['writer-up aurora-instance-3', 'reader-up aurora-instance-1',
+                               'reader-up aurora-instance-2', 'completed'],
+                   'final_classes': {'aurora-instance-1': 'db.x2g.xlarge', 'aurora-instance-2': 'db.x2g.xlarge',
+                                     'aurora-instance-3 (writer)': 'db.x2g.xlarge'},
+                   'write_downtime_s': 30},
+    },
+    {
+        'name': 'writer-scale-up-failover-no-readers',
+        'description': 'writer-scale-up-failover without readers; the writer is resized in place with an alert',
+        'cluster': ('db.r6g.large', []),
+        'script': [(0, 'alarm', ['aurora-instance-1'])],
+        'env': {'WRITER_SCALE_STRATEGY': 'failover'},
+        'expect': {'actions': ['writer-up aurora-instance-1', 'completed'],
+                   'final_classes': 'db.r6g.xlarge', 'write_downtime_s': 600},
+    },
+    {
+        'name': 'full-ladder',
+        'description': 'an alarm every 20 minutes for two hours',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        'script': [(minute * 60, 'alarm', ['aurora-instance-1']) for minute in range(0, 120, 20)],
+        'expect': {'changes': ['reader-up', 'writer-up aurora-instance-1', 'reader-up'] * 3,
+                   'final_classes': 'db.r6g.4xlarge', 'write_downtime_s': 1800},
+    },
+    {
+        'name': 'alarm-storm',
+        'description': 'alarms of three instances fire at the same time and run concurrently',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        'script': [(0, 'alarm', ['aurora-instance-1', 'aurora-instance-2', 'aurora-instance-3'])],
+        # reproduces the race of the tag checks, see alarm-storm-locked
+        'expected_violations': True,
+        'expect': {'final_classes': 'db.r6g.xlarge', 'write_downtime_s': 600},
+    },
+    {
+        'name': 'alarm-during-propagation',
+        'description': 'a second alarm arrives while the event lambda is propagating the first scale-up',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        'script': [(0, 'alarm', ['aurora-instance-1']), (605, 'alarm', ['aurora-instance-2'])],
+        'expect': {'changes': ['reader-up', 'writer-up aurora-instance-1', 'reader-up'],
+                   'final_classes': 'db.r6g.xlarge', 'write_downtime_s': 600},
+    },
+    {
+        'name': 'alarm-storm-locked',
+        'description': 'alarm-storm with the DynamoDB scaling lock',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        'script': [(0, 'alarm', ['aurora-instance-1', 'aurora-instance-2', 'aurora-instance-3'])],
+        'env': {'LOCK_TABLE': 'rds-vscale-locks'},
+        'expect': {'changes': ['reader-up', 'writer-up aurora-instance-1', 'reader-up'],
+                   'final_classes': 'db.r6g.xlarge', 'write_downtime_s': 600},
+    },
+    {
+        'name': 'full-ladder-locked',
+        'description': 'full-ladder with the DynamoDB scaling lock',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        'script': [(minute * 60, 'alarm', ['aurora-instance-1']) for minute in range(0, 120, 20)],
+        'env': {'LOCK_TABLE': 'rds-vscale-locks'},
+        'expect': {'changes': ['reader-up', 'writer-up aurora-instance-1', 'reader-up'] * 3,
+                   'final_classes': 'db.r6g.4xlarge', 'write_downtime_s': 1800},
+    },
+    {
+        'name': 'fleet',
+        'description': 'one event lambda serving four clusters in the fleet mode; their alarms fire at the same time',
+        'clusters': {
+            'aurora-a': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+            'aurora-b': ('db.r6g.large', ['db.r6g.large']),
+            'aurora-c': ('db.r6g.xlarge', ['db.r6g.xlarge', 'db.r6g.xlarge', 'db.r6g.xlarge']),
+            'aurora-d': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        },
+        'script': [(0, 'alarm', [f"aurora-{name}-instance-1" for name in 'abcd'])],
+        'env': {'FLEET_CONFIG': json.dumps({
+            'defaults': {'size_order': SIZE_ORDER},
+            'clusters': {'aurora-a': {}, 'aurora-b': {}, 'aurora-c': {}, 'aurora-d': {'max_instance_class': 'db.r6g.large'}},
+        })},
+        'expect': {'final_classes': {
+            **{f"aurora-a-instance-{n}{' (writer)' if n == 1 else ''}": 'db.r6g.xlarge' for n in (1, 2, 3)},
+            **{f"aurora-b-instance-{n}{' (writer)' if n == 1 else ''}": 'db.r6g.xlarge' for n in (1, 2)},
+            **{f"aurora-c-instance-{n}{' (writer)' if n == 1 else ''}": 'db.r6g.2xlarge' for n in (1, 2, 3, 4)},
+            **{f"aurora-d-instance-{n}{' (writer)' if n == 1 else ''}": 'db.r6g.large' for n in (1, 2, 3)},
+        }},
+    },
+    {
+        'name': 'fleet-cluster-tag',
+        'description': 'fleet mode with a Cluster tag of the instances other than the cluster identifier; '
+                       'both functions take the settings of the identifier',
+        'clusters': {'aurora-a': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large'])},
+        'instance_tags': {'aurora-a': {'Cluster': 'orders'}},
+        'script': [(0, 'alarm', ['aurora-a-instance-1'])],
+        'env': {'FLEET_CONFIG': json.dumps({'defaults': {'size_order': SIZE_ORDER}, 'clusters': {'aurora-a': {}}})},
+        'expect': {'changes': ['reader-up', 'writer-up aurora-a-instance-1', 'reader-up'],
+                   'final_classes': 'db.r6g.xlarge', 'write_downtime_s': 600},
+    },
+    {
+        'name': 'writer-scale-up-failover-locked',
+        'description': 'writer-scale-up-failover with the DynamoDB scaling lock',
+        'cluster': ('db.r6g.large', ['db.r6g.xlarge', 'db.r6g.xlarge']),
+        'script': [(0, 'alarm', ['aurora-instance-1'])],
+        'env': {'WRITER_SCALE_STRATEGY': 'failover', 'LOCK_TABLE': 'rds-vscale-locks'},
+        'expect': {'actions': ['writer-up aurora-instance-2', 'reader-up aurora-instance-1', 'completed'],
+                   'final_classes': 'db.r6g.xlarge', 'write_downtime_s': 30},
+    },
+    {
+        'name': 'reader-load-aware',
+        'description': 'one alarm, the readers are resized from the least loaded to the busiest one',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large', 'db.r6g.large']),
+        'script': [(0, 'alarm', ['aurora-instance-1'])],
+        'metrics': {
+            'aurora-instance-2': {'CPUUtilization': 85.0, 'DatabaseConnections': 240, 'AuroraReplicaLag': 40.0},
+            'aurora-instance-3': {'CPUUtilization': 12.0, 'DatabaseConnections': 15, 'AuroraReplicaLag': 8.0},
+            'aurora-instance-4': {'CPUUtilization': 45.0, 'DatabaseConnections': 90, 'AuroraReplicaLag': 15.0},
+        },
+        'expect': {'actions': ['reader-up aurora-instance-3', 'writer-up aurora-instance-1', 'reader-up aurora-instance-4',
+                               'reader-up aurora-instance-2', 'completed'],
+                   'final_classes': 'db.r6g.xlarge'},
+    },
+    {
+        'name': 'memory-bottleneck',
+        'description': 'an alarm of an instance short of memory with the x2g classes in the size order',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        'script': [(0, 'alarm', ['aurora-instance-1'])],
+        'metrics': {
+            'aurora-instance-1': {'CPUUtilization': 55.0, 'FreeableMemory': 0.8 * 1024 ** 3,
+                                  'BufferCacheHitRatio': 86.0, 'DatabaseConnections': 120},
+        },
+        'env': {'SIZE_ORDER': json.dumps(MIXED_SIZE_ORDER)},
+        'expect': {'final_classes': 'db.x2g.large'},
+    },
+    {
+        'name': 'cpu-bottleneck',
+        'description': 'memory-bottleneck with a busy CPU and enough memory instead',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        'script': [(0, 'alarm', ['aurora-instance-1'])],
+        'metrics': {
+            'aurora-instance-1': {'CPUUtilization': 92.0, 'FreeableMemory': 6.0 * 1024 ** 3,
+                                  'BufferCacheHitRatio': 99.5, 'DatabaseConnections': 120},
+        },
+        'env': {'SIZE_ORDER': json.dumps(MIXED_SIZE_ORDER)},
+        'expect': {'final_classes': 'db.r6g.xlarge'},
+    },
+    {
+        'name': 'horizontal',
+        'description': 'the instances are of the largest class; replicas are added up to 3 readers and removed after the OK state',
+        'cluster': ('db.r6g.4xlarge', ['db.r6g.4xlarge']),
+        'script': [(minute * 60, 'alarm', ['aurora-instance-1']) for minute in (0, 20, 40)]
+                  + [(minute * 60, 'ok', ['aurora-instance-1']) for minute in (60, 80, 100)],
+        'env': {'MAX_READERS': '3'},
+        'expect': {'changes': ['reader-added aurora-autoscaled-20240401000000', 'reader-added aurora-autoscaled-20240401002000',
+                               'reader-removed aurora-autoscaled-20240401002000', 'reader-removed aurora-autoscaled-20240401000000'],
+                   'final_classes': {'aurora-instance-1 (writer)': 'db.r6g.4xlarge', 'aurora-instance-2': 'db.r6g.4xlarge'},
+                   'write_downtime_s': 0},
+    },
+    {
+        'name': 'horizontal-locked',
+        'description': 'horizontal with the DynamoDB scaling lock',
+        'cluster': ('db.r6g.4xlarge', ['db.r6g.4xlarge']),
+        'script': [(minute * 60, 'alarm', ['aurora-instance-1']) for minute in (0, 20, 40)]
+                  + [(minute * 60, 'ok', ['aurora-instance-1']) for minute in (60, 80, 100)],
+        'env': {'MAX_READERS': '3', 'LOCK_TABLE': 'rds-vscale-locks'},
+        'expect': {'changes': ['reader-added aurora-autoscaled-20240401000000', 'reader-added aurora-autoscaled-20240401002000',
+                               'reader-removed aurora-autoscaled-20240401002000', 'reader-removed aurora-autoscaled-20240401000000'],
+                   'final_classes': {'aurora-instance-1 (writer)': 'db.r6g.4xlarge', 'aurora-instance-2': 'db.r6g.4xlarge'},
+                   'write_downtime_s': 0},
+    },
+    {
+        'name': 'horizontal-scale-in-cooldown',
+        'description': 'horizontal with OK states 10 minutes apart; the second removal waits for the cooldown of the first',
+        'cluster': ('db.r6g.4xlarge', ['db.r6g.4xlarge']),
+        'script': [(minute * 60, 'alarm', ['aurora-instance-1']) for minute in (0, 20)]
+                  + [(minute * 60, 'ok', ['aurora-instance-1']) for minute in (40, 50, 60)],
+        'env': {'MAX_READERS': '3'},
+        'expect': {'actions': ['reader-added aurora-autoscaled-20240401000000', 'completed',
+                               'reader-added aurora-autoscaled-20240401002000', 'completed',
+                               'reader-removed aurora-autoscaled-20240401002000', 'completed', 'cooldown-skipped',
+                               'reader-removed aurora-autoscaled-20240401000000', 'completed'],
+                   'final_classes': {'aurora-instance-1 (writer)': 'db.r6g.4xlarge', 'aurora-instance-2': 'db.r6g.4xlarge'}},
+    },
+    {
+        'name': 'horizontal-busy-scale-in',
+        'description': 'horizontal with an INSUFFICIENT_DATA state, which is ignored, and an OK state while '
+                       'a reader is still busy; the reader is removed after the next OK state',
+        'cluster': ('db.r6g.4xlarge', ['db.r6g.4xlarge']),
+        'script': [(0, 'alarm', ['aurora-instance-1']), (20 * 60, 'insufficient-data', ['aurora-instance-1']),
+                   (40 * 60, 'metrics', {'aurora-instance-2': {'CPUUtilization': 80.0}}),
+                   (40 * 60, 'ok', ['aurora-instance-1']),
+                   (50 * 60, 'metrics', {'aurora-instance-2': {'CPUUtilization': 20.0}}),
+                   (60 * 60, 'ok', ['aurora-instance-1'])],
+        'env': {'MAX_READERS': '3'},
+        'expect': {'actions': ['reader-added aurora-autoscaled-20240401000000', 'completed', 'ignored', 'load-skipped',
+                               'reader-removed aurora-autoscaled-20240401000000', 'completed'],
+                   'final_classes': {'aurora-instance-1 (writer)': 'db.r6g.4xlarge', 'aurora-instance-2': 'db.r6g.4xlarge'}},
+    },
+    {
+        'name': 'scheduled-window',
+        'description': 'the schedule runs every 5 minutes; the cluster is pre-scaled for a 02:00-03:00 window and scaled back after it',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        'script': [(minute * 60, 'schedule', None) for minute in range(0, 300, 5)],
+        'env': {'CAPACITY_CALENDAR': json.dumps([{
+            'cluster': 'aurora', 'min_class': 'db.r6g.2xlarge',
+            'start': '2024-04-01T02:00:00+00:00', 'end': '2024-04-01T03:00:00+00:00',
+        }])},
+        'expect': {'changes': ['reader-up', 'reader-up', 'writer-up aurora-instance-1',
+                               'reader-down', 'reader-down', 'writer-down aurora-instance-1'],
+                   'classes_at': {7200: 'db.r6g.2xlarge'},
+                   'final_classes': 'db.r6g.large', 'write_downtime_s': 1200},
+    },
+    {
+        'name': 'scheduled-window-large-cluster',
+        'description': 'scheduled-window with four readers; the lead time grows with the number of members, '
+                       'so the writer is resized before the window starts',
+        'cluster': ('db.r6g.large', ['db.r6g.large'] * 4),
+        'script': [(minute * 60, 'schedule', None) for minute in range(0, 300, 5)],
+        'env': {'CAPACITY_CALENDAR': json.dumps([{
+            'cluster': 'aurora', 'min_class': 'db.r6g.2xlarge',
+            'start': '2024-04-01T02:00:00+00:00', 'end': '2024-04-01T03:00:00+00:00',
+        }])},
+        'expect': {'changes': ['reader-up'] * 4 + ['writer-up aurora-instance-1'] + ['reader-down'] * 4
+                              + ['writer-down aurora-instance-1'],
+                   'classes_at': {7200: 'db.r6g.2xlarge'},
+                   'final_classes': 'db.r6g.large', 'write_downtime_s': 1200},
+    },
+    {
+        'name': 'scheduled-window-busy-release',
+        'description': 'scheduled-window with the writer still busy after the window; '
+                       'the cluster is scaled back once the CPU goes down',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        'script': [(minute * 60, 'schedule', None) for minute in range(0, 300, 5)]
+                  + [(175 * 60, 'metrics', {'aurora-instance-1': {'CPUUtilization': 85.0}}),
+                     (215 * 60, 'metrics', {'aurora-instance-1': {'CPUUtilization': 20.0}})],
+        'env': {'CAPACITY_CALENDAR': json.dumps([{
+            'cluster': 'aurora', 'min_class': 'db.r6g.2xlarge',
+            'start': '2024-04-01T02:00:00+00:00', 'end': '2024-04-01T03:00:00+00:00',
+        }])},
+        'expect': {'changes': ['reader-up', 'reader-up', 'writer-up aurora-instance-1',
+                               'reader-down', 'reader-down', 'writer-down aurora-instance-1'],
+                   'classes_at': {12900: 'db.r6g.2xlarge'},
+                   'final_classes': 'db.r6g.large', 'write_downtime_s': 1200},
+    },
+    {
+        'name': 'scheduled-window-failover-locked',
+        'description': 'scheduled-window as a daily window, with the failover strategy, the DynamoDB scaling lock '
+                       'and an alarm during the window',
+        'cluster': ('db.r6g.large', ['db.r6g.large', 'db.r6g.large']),
+        'script': [(minute * 60, 'schedule', None) for minute in range(0, 300, 5)]
+                  + [(150 * 60, 'alarm', ['aurora-instance-2'])],
+        'env': {
+            'CAPACITY_CALENDAR': json.dumps([{'cluster': 'aurora', 'min_class': 'db.r6g.xlarge', 'start': '02:00', 'end': '03:00'}]),
+            'WRITER_SCALE_STRATEGY': 'failover',
+            'LOCK_TABLE': 'rds-vscale-locks',
+        },
+        'expect': {'changes': ['reader-up', 'reader-up', 'writer-up aurora-instance-2', 'reader-up aurora-instance-1',
+                               'reader-up', 'writer-up', 'reader-up', 'reader-up'],
+                   'classes_at': {7200: {'aurora-instance-1': 'db.r6g.xlarge', 'aurora-instance-2 (writer)': 'db.r6g.xlarge',
+                                         'aurora-instance-3': 'db.r6g.xlarge'}},
+                   'final_classes': 'db.r6g.2xlarge', 'write_downtime_s': 60},
+    },
+]
+
+
+def alarm_event(instance_identifier, state='ALARM'):
+    """
+    SNS notification of a CloudWatch alarm for the instance
+    """
+    message = {
+        'AlarmName': f"{instance_identifier}-cpu",
+        'NewStateValue': state,
+        'Trigger': {
+            'MetricName': 'CPUUtilization',
+            'Namespace': 'AWS/RDS',
+            'Dimensions': [{'name': 'DBInstanceIdentifier', 'value': instance_identifier}],
+        },
+    }
+    return {'Records': [{'Sns': {'Message': json.dumps(message)}}]}
+
+
+def schedule_event():
+    """
+    EventBridge scheduled event
+    """
+    return {'source': 'aws.events', 'detail-type': 'Scheduled Event', 'detail': {}}
+
+
+def rds_event(messages):
+    """
+    SNS notification of RDS events
+    """
+    return {'Records': [{'Sns': {'Message': json.dumps(message)}} for message in messages]}
+
+
+def load_module(file_name, module_name, backend):
+    """
+    import a module of the lambdas with its clock replaced by the virtual one
+    """
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(HERE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    if hasattr(module, 'datetime'):
+        module.datetime = backend.clock.datetime_class()
+    return module
+
+
+def load_lambdas(backend):
+    """
+    import the lambdas (with a fresh copy of the core module reading the current environment)
+    and point the shared clients at the fake backend
+    """
+    core = load_module('rds_vscale_core.py', 'rds_vscale_core', backend)
+    # the clients are created on first use, so pre-populating them is enough
+    core._clients.update({  # pylint: disable=protected-access
+        service: core.InstrumentedClient(sim.make_client(backend, service), service)
+        for service in ('rds', 'sns', 'cloudwatch', 'dynamodb')
+    })
+    load_module('rds_vscale_lock.py', 'rds_vscale_lock', backend)
+    load_module('rds_vscale_decision.py', 'rds_vscale_decision', backend)
+    alarm_module = load_module('rds_vscale_alarm_lambda.py', 'bench_alarm_lambda', backend)
+    event_module = load_module('rds_vscale_event_lambda.py', 'bench_event_lambda', backend)
+    schedule_module = load_module('rds_vscale_schedule_lambda.py', 'bench_schedule_lambda', backend)
+    return alarm_module, event_module, schedule_module
+
+
+class Context:
+    """
+    minimal lambda context
+    """
+    def __init__(self, request_id):
+        self.aws_request_id = request_id
+
+
+def read_metrics(output):
+    """
+    EMF documents printed by the lambdas, by request id (the documents of the clusters of an invocation
+    first, the one of the invocation last)
+    """
+    documents = {}
+    for line in output.splitlines():
+        if not line.startswith('{') or '"_aws"' not in line:
+            continue
+        try:
+            document = json.loads(line)
+        except ValueError:
+            continue
+        documents.setdefault(document.get('RequestId'), []).append(document)
+    return documents
+
+
+class Runner:
+    """
+    runs one scenario
+    """
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.backend = sim.FakeBackend()
+        for cluster_identifier, layout in (scenario.get('clusters') or {'aurora': scenario['cluster']}).items():
+            self.backend.add_cluster(cluster_identifier, *layout,
+                                     instance_tags=scenario.get('instance_tags', {}).get(cluster_identifier))
+        for instance_identifier, metrics in scenario.get('metrics', {}).items():
+            for metric_name, value in metrics.items():
+                self.backend.set_metric(instance_identifier, metric_name, value)
+        self.env = dict(DEFAULT_ENV, **scenario.get('env', {}))
+        self.invocations = []
+        self.errors = []
+        self.queue = []
+        self.snapshots = {}
+
+    def push(self, delay, kind, payload):
+        self.queue.append((self.backend.clock.now() + timedelta(seconds=delay), len(self.queue), kind, payload))
+        self.queue.sort(key=lambda item: (item[0], item[1]))
+
+    def invoke(self, name, module, event):
+        self.backend.begin(name)
+        started = time.perf_counter()
+        result = None
+        try:
+            result = module.lambda_handler(event, Context(name))
+        except Exception as e:  # pylint: disable=broad-except
+            self.errors.append(f"{name}: {type(e).__name__}: {e}")
+            result = f"{type(e).__name__}: {e}"
+        finally:
+            wall = time.perf_counter() - started
+            if self.backend.turnstile:
+                self.backend.turnstile.leave(name)
+        self.invocations.append({
+            'name': name,
+            'at': self.backend.clock.elapsed(),
+            'wall_ms': round(wall * 1000, 3),
+            'calls': dict(self.backend.calls_of(name)),
+            'api_calls': sum(self.backend.calls_of(name).values()),
+            'result': result if isinstance(result, (str, type(None))) else result.get('statusCode'),
+        })
+
+    def invoke_all(self, batch):
+        if len(batch) == 1:
+            self.invoke(*batch[0])
+            return
+        # concurrent invocations take turns at every API call
+        self.backend.turnstile = sim.Turnstile()
+        for name, _, _ in batch:
+            self.backend.turnstile.join(name)
+        threads = [threading.Thread(target=self.invoke, args=item) for item in batch]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.backend.turnstile = None
+
+    def check_invariants(self):
+        backend = self.backend
+        size_order = json.loads(self.env['SIZE_ORDER'])
+        for cluster_identifier, cluster in backend.clusters.items():
+            writers = [m for m in cluster['Members'] if m['IsClusterWriter']]
+            if len(writers) != 1:
+                backend.violations.append(f"{backend.clock.elapsed():.0f}s: {cluster_identifier} has {len(writers)} writers")
+            for member in cluster['Members']:
+                instance_class = backend.instances[member['DBInstanceIdentifier']]['DBInstanceClass']
+                if instance_class not in size_order:
+                    backend.violations.append(
+                        f"{backend.clock.elapsed():.0f}s: {member['DBInstanceIdentifier']} has the unknown class {instance_class}"
+                    )
+
+    def member_classes(self):
+        """
+        classes of the cluster members (and the status of those not available)
+        """
+        backend = self.backend
+        classes = {}
+        for cluster in backend.clusters.values():
+            for member in cluster['Members']:
+                instance = backend.instances[member['DBInstanceIdentifier']]
+                name = member['DBInstanceIdentifier'] + (' (writer)' if member['IsClusterWriter'] else '')
+                classes[name] = instance['DBInstanceClass']
+                if instance['DBInstanceStatus'] != 'available':
+                    classes[name] += f" ({instance['DBInstanceStatus']})"
+        return classes
+
+    def run(self, alarm_module, event_module, schedule_module):
+        backend = self.backend
+        for delay, kind, payload in self.scenario['script']:
+            self.push(delay, kind, payload)
+        for moment in self.scenario.get('expect', {}).get('classes_at', {}):
+            self.push(moment, 'snapshot', None)
+        last_change = 0.0
+        counter = Counter()
+        while self.queue or backend.pending:
+            if len(self.invocations) >= MAX_INVOCATIONS:
+                self.errors.append(f"stopped after {MAX_INVOCATIONS} invocations")
+                break
+            next_transition = backend.next_transition()
+            if next_transition is not None and (not self.queue or next_transition <= self.queue[0][0]):
+                emitted = backend.run_until(next_transition)
+                last_change = backend.clock.elapsed()
+                if emitted:
+                    self.push(EVENT_DELIVERY_DELAY, 'event', emitted)
+                self.check_invariants()
+                continue
+            moment = self.queue[0][0]
+            backend.clock.advance_to(moment)
+            batch = []
+            while self.queue and self.queue[0][0] == moment:
+                _, _, kind, payload = self.queue.pop(0)
+                if kind == 'snapshot':
+                    self.snapshots[backend.clock.elapsed()] = self.member_classes()
+                elif kind in ALARM_STATES:
+                    state = ALARM_STATES[kind]
+                    for instance_identifier in payload:
+                        counter['alarm'] += 1
+                        batch.append((f"alarm#{counter['alarm']}", alarm_module, alarm_event(instance_identifier, state)))
+                elif kind == 'metrics':
+                    for instance_identifier, metrics in payload.items():
+                        for metric_name, value in metrics.items():
+                            backend.set_metric(instance_identifier, metric_name, value)
+                elif kind == 'schedule':
+                    counter['schedule'] += 1
+                    batch.append((f"schedule#{counter['schedule']}", schedule_module, schedule_event()))
+                else:
+                    counter['event'] += 1
+                    batch.append((f"event#{counter['event']}", event_module, rds_event(payload)))
+            if batch:
+                self.invoke_all(batch)
+            self.check_invariants()
+        return last_change
+
+    def report(self, last_change, output):
+        backend = self.backend
+        documents = read_metrics(output)
+        for invocation in self.invocations:
+            *cluster_documents, document = documents.get(invocation['name']) or [{}]
+            invocation['action'] = document.get('Action')
+            invocation['decision_ms'] = document.get('DecisionTime')
+            invocation['classes'] = (document.get('BeforeClass'), document.get('AfterClass'))
+            invocation['instance'] = document.get('InstanceIdentifier')
+            invocation['clusters'] = [{
+                'cluster': cluster_document.get('ClusterIdentifier'),
+                'action': cluster_document.get('Action'),
+                'classes': (cluster_document.get('BeforeClass'), cluster_document.get('AfterClass')),
+                'instance': cluster_document.get('InstanceIdentifier'),
+            } for cluster_document in cluster_documents]
+        totals = Counter()
+        for invocation in self.invocations:
+            totals.update(invocation['calls'])
+        report = {
+            'scenario': self.scenario['name'],
+            'description': self.scenario['description'],
+            'invocations': self.invocations,
+            'api_calls': sum(totals.values()),
+            'api_calls_by_operation': dict(sorted(totals.items())),
+            'wall_ms': round(sum(i['wall_ms'] for i in self.invocations), 3),
+            'convergence_s': last_change,
+            'write_downtime_s': backend.write_downtime,
+            'final_classes': self.member_classes(),
+            'classes_at': self.snapshots,
+            'sns_messages': len(backend.messages),
+            'violations': backend.violations,
+            'expected_violations': self.scenario.get('expected_violations', False),
+            'errors': self.errors,
+        }
+        report['mismatches'] = check_expectations(report, self.scenario.get('expect', {}))
+        return report
+
+
+def summaries(invocation):
+    """
+    the actions of the invocation and the instances they acted on, e.g. ['reader-up aurora-instance-2']
+    """
+    decisions = invocation['clusters'] or [invocation]
+    return [f"{decision['action'] or invocation['result']} {decision['instance']}" if decision['instance']
+            else decision['action'] or invocation['result'] for decision in decisions]
+
+
+def check_expectations(report, expect):
+    """
+    differences between the report and the expected outcome of the scenario
+    """
+    mismatches = []
+    actions = [action for invocation in report['invocations'] for action in summaries(invocation)]
+    changes = [action for action in actions if action.split()[0].endswith(CHANGE_SUFFIXES)]
+    observed = {
+        'actions': actions,
+        'changes': changes,
+        'final_classes': report['final_classes'],
+        'write_downtime_s': report['write_downtime_s'],
+    }
+    for key, value in expect.items():
+        if key == 'classes_at':
+            for moment, classes in value.items():
+                if not classes_match(classes, report['classes_at'].get(moment)):
+                    mismatches.append(f"classes at {moment}s: expected {classes}, got {report['classes_at'].get(moment)}")
+        elif key == 'final_classes':
+            if not classes_match(value, observed[key]):
+                mismatches.append(f"{key}: expected {value}, got {observed[key]}")
+        elif key in ('actions', 'changes'):
+            if not actions_match(value, observed[key]):
+                mismatches.append(f"{key}: expected {value}, got {observed[key]}")
+        elif observed[key] != value:
+            mismatches.append(f"{key}: expected {value}, got {observed[key]}")
+    return mismatches
+
+
+def actions_match(expected, observed):
+    """
+    an expected action without an instance matches the action on any instance
+    """
+    return len(expected) == len(observed) and all(
+        action == item or action == item.split()[0] for action, item in zip(expected, observed))
+
+
+def classes_match(expected, observed):
+    """
+    a single expected class is the class of every member
+    """
+    if isinstance(expected, str):
+        return bool(observed) and all(instance_class == expected for instance_class in observed.values())
+    return expected == observed
+
+
+def run_scenario(scenario, verbose=False):
+    """
+    run the scenario and return its report
+    """
+    runner = Runner(scenario)
+    output = io.StringIO()
+    with mock.patch.dict(os.environ, runner.env):
+        alarm_module, event_module, schedule_module = load_lambdas(runner.backend)
+        with contextlib.redirect_stdout(output):
+            last_change = runner.run(alarm_module, event_module, schedule_module)
+    if verbose:
+        print(output.getvalue())
+    return runner.report(last_change, output.getvalue())
+
+
+def print_report(report):
+    print(f"== {report['scenario']}: {report['description']}")
+    for invocation in report['invocations']:
+        print(f"  {invocation['at']:>7.0f}s {invocation['name']:<10} {invocation['api_calls']:>4} calls "
+              f"{invocation['wall_ms']:>9.3f} ms  {invocation['action'] or invocation['result']}"
+              + (f" {invocation['classes'][0]} -> {invocation['classes'][1]}" if invocation['classes'][1] else "")
+              + (f" ({invocation['instance']})" if invocation['instance'] else ""))
+        for cluster in invocation['clusters']:
+            print(f"  {'':>8} {cluster['cluster']:<20} {cluster['action']}"
+                  + (f" {cluster['classes'][0]} -> {cluster['classes'][1]}" if cluster['classes'][1] else "")
+                  + (f" ({cluster['instance']})" if cluster['instance'] else ""))
+    print(f"  API calls: {report['api_calls']} "
+          + ", ".join(f"{operation}={count}" for operation, count in report['api_calls_by_operation'].items()))
+    print(f"  wall time: {report['wall_ms']:.3f} ms, convergence: {report['convergence_s']:.0f} s, "
+          f"write downtime: {report['write_downtime_s']:.0f} s, SNS messages: {report['sns_messages']}")
+    print("  final: " + ", ".join(f"{name}={instance_class}" for name, instance_class in report['final_classes'].items()))
+    for violation in report['violations']:
+        print(f"  VIOLATION{' (expected)' if report['expected_violations'] else ''} {violation}")
+    for error in report['errors']:
+        print(f"  ERROR {error}")
+    for mismatch in report['mismatches']:
+        print(f"  MISMATCH {mismatch}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', action='append', help='scenario to run (default: all)')
+    parser.add_argument('--json', action='store_true', help='print the reports as JSON')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the lambdas')
+    args = parser.parse_args()
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or s['name'] in args.scenario]
+    reports = [run_scenario(scenario, args.verbose) for scenario in scenarios]
+    if args.json:
+        print(json.dumps(reports, indent=2, default=str))
+    else:
+        for report in reports:
+            print_report(report)
+    failed = [report for report in reports
+              if report['errors'] or report['mismatches'] or (report['violations'] and not report['expected_violations'])]
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,621 @@
+"""
+Code shared by the alarm, event and schedule lambdas.
+
+AWS clients are created on first use (not at import time) and reused by
+subsequent invocations of a warm container. Calls made through them are
+counted and timed, and every invocation prints its metrics to stdout in the
+CloudWatch Embedded Metric Format (EMF), along with a document per cluster
+if it handles several of them.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+from botocore.exceptions import ClientError
+
+
+size_order_str = os.environ.get("SIZE_ORDER", "[]")
+SIZE_ORDER = json.loads(size_order_str)
+MODIFYING_STATUSES = ["modifying", "storage-optimization", "creating", "rebooting", "deleting"]
+MODIFY_COOLDOWN_PERIOD = int(os.environ.get("MODIFY_COOLDOWN_PERIOD", "900"))
+# "modify" resizes the writer in place, "failover" promotes a reader of the target size instead
+WRITER_SCALE_STRATEGY = os.environ.get("WRITER_SCALE_STRATEGY", "modify")
+# Replicas may be added up to this number of readers once the readers are of the largest class (0 turns it off)
+MAX_READERS = int(os.environ.get("MAX_READERS", "0"))
+# "load" resizes the least loaded of the eligible readers first, "random" picks any of them
+READER_SELECTION = os.environ.get("READER_SELECTION", "load")
+READER_LOAD_METRICS = ["CPUUtilization", "DatabaseConnections", "AuroraReplicaLag"]
+READER_LOAD_PERIOD = int(os.environ.get("READER_LOAD_PERIOD", "300"))
+# Capacity is only removed (scheduled scale-downs, readers added by the alarm) while the CPU of every member is below it
+SCALE_IN_CPU_PERCENT = float(os.environ.get("SCALE_IN_CPU_PERCENT", "40"))
+# Per-cluster settings of the fleet mode: a JSON document or the path to a JSON file
+FLEET_CONFIG = os.environ.get("FLEET_CONFIG")
+
+# The number of AWS API calls a single invocation may run concurrently; the HTTP pool is sized to match it
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "10"))
+API_CONNECT_TIMEOUT = float(os.environ.get("API_CONNECT_TIMEOUT", "2"))
+API_READ_TIMEOUT = float(os.environ.get("API_READ_TIMEOUT", "10"))
+API_MAX_ATTEMPTS = int(os.environ.get("API_MAX_ATTEMPTS", "5"))
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "RDSVerticalAutoscaler")
+
+sns_topic_arn = os.environ.get('ALARMS_SNS')
+
+_clients = {}
+_clients_lock = threading.Lock()
+_executor = None
+_fleet_config = None
+_current_metrics = contextvars.ContextVar('rds_vscale_metrics', default=None)
+
+
+class InvocationMetrics:
+    """
+    metrics collected during a single invocation
+    """
+    def __init__(self, function_name, request_id=None):
+        self.function_name = function_name
+        self.request_id = request_id
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.call_time = defaultdict(float)
+        self.action = "none"
+        self.properties = {}
+
+    def record_call(self, operation, seconds):
+        with self.lock:
+            self.calls[operation] += 1
+            self.call_time[operation] += seconds
+
+    def record_decision(self, action, properties):
+        with self.lock:
+            self.action = action
+            self.properties.update({k: v for k, v in properties.items() if v is not None})
+
+    def document(self, decision_seconds):
+        """
+        the EMF document of the invocation
+        """
+        metrics = [
+            {'Name': 'DecisionTime', 'Unit': 'Milliseconds'},
+            {'Name': 'ApiCalls', 'Unit': 'Count'},
+            {'Name': 'ApiTime', 'Unit': 'Milliseconds'},
+        ]
+        document = {
+            'Function': self.function_name,
+            'Action': self.action,
+            'DecisionTime': round(decision_seconds * 1000, 3),
+            'ApiCalls': sum(self.calls.values()),
+            'ApiTime': round(sum(self.call_time.values()) * 1000, 3),
+        }
+        for operation in sorted(self.calls):
+            metrics.append({'Name': f"ApiCalls.{operation}", 'Unit': 'Count'})
+            metrics.append({'Name': f"ApiTime.{operation}", 'Unit': 'Milliseconds'})
+            document[f"ApiCalls.{operation}"] = self.calls[operation]
+            document[f"ApiTime.{operation}"] = round(self.call_time[operation] * 1000, 3)
+        document.update(self.properties)
+        if self.request_id:
+            document['RequestId'] = self.request_id
+        document['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Function', 'Action']],
+                'Metrics': metrics,
+            }],
+        }
+        return document
+
+
+class InstrumentedClient:
+    """
+    proxy of a boto3 client counting and timing the API calls for the metrics of the current invocation
+    """
+    def __init__(self, client, service_name):
+        self._client = client
+        self._service_name = service_name
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+        operation = f"{self._service_name}.{name}"
+
+        @functools.wraps(attribute)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                metrics = _current_metrics.get()
+                if metrics is not None:
+                    metrics.record_call(operation, time.perf_counter() - started)
+
+        # cache the wrapper, so __getattr__ is called only once per method
+        setattr(self, name, timed)
+        return timed
+
+
+def instrumented(function_name):
+    """
+    decorator of a lambda handler printing the metrics of every invocation in EMF
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not METRICS_ENABLED:
+                return handler(event, context)
+            metrics = InvocationMetrics(function_name, getattr(context, 'aws_request_id', None))
+            token = _current_metrics.set(metrics)
+            started = time.perf_counter()
+            try:
+                return handler(event, context)
+            except Exception:
+                metrics.record_decision("failed", {})
+                raise
+            finally:
+                _current_metrics.reset(token)
+                print(json.dumps(metrics.document(time.perf_counter() - started)))
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def cluster_metrics(cluster_identifier, separate=True):
+    """
+    collect the metrics of one cluster of the invocation in a document of its own
+    """
+    parent = _current_metrics.get()
+    if not separate or parent is None:
+        yield
+        return
+    parent.record_decision("batch", {})
+    metrics = InvocationMetrics(parent.function_name, parent.request_id)
+    metrics.record_decision(metrics.action, {'ClusterIdentifier': cluster_identifier})
+    token = _current_metrics.set(metrics)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.record_decision("failed", {})
+        raise
+    finally:
+        _current_metrics.reset(token)
+        print(json.dumps(metrics.document(time.perf_counter() - started)))
+
+
+def record_decision(action, before_class=None, after_class=None, **properties):
+    """
+    set the action chosen by the current invocation (e.g. writer-up, reader-up, cooldown-skipped,
+    modifying-skipped) and the instance classes before and after it
+    """
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.record_decision(action, dict(properties, BeforeClass=before_class, AfterClass=after_class))
+
+
+def get_client(service_name):
+    """
+    get the shared client of the AWS service, creating it on first use
+    """
+    client = _clients.get(service_name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service_name)
+            if client is None:
+                # boto3 is imported here so it doesn't add to the import time of the lambdas
+                import boto3  # pylint: disable=import-outside-toplevel
+                from botocore.config import Config  # pylint: disable=import-outside-toplevel
+                config = Config(
+                    max_pool_connections=MAX_CONCURRENCY,
+                    connect_timeout=API_CONNECT_TIMEOUT,
+                    read_timeout=API_READ_TIMEOUT,
+                    retries={'mode': 'adaptive', 'total_max_attempts': API_MAX_ATTEMPTS},
+                )
+                client = InstrumentedClient(boto3.client(service_name, config=config), service_name)
+                _clients[service_name] = client
+    return client
+
+
+def map_concurrently(function, items):
+    """
+    call the function for every item using up to MAX_CONCURRENCY threads (kept for later invocations)
+    """
+    global _executor  # pylint: disable=global-statement
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    if _executor is None:
+        from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+        _executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+    # every thread runs in a copy of the current context, so the calls count for the invocation metrics
+    futures = [_executor.submit(contextvars.copy_context().run, function, item) for item in items]
+    return [future.result() for future in futures]
+
+
+def default_cluster_config():
+    """
+    settings of a cluster taken from the environment variables
+    """
+    return {
+        'size_order': SIZE_ORDER,
+        'cooldown': MODIFY_COOLDOWN_PERIOD,
+        'writer_scale_strategy': WRITER_SCALE_STRATEGY,
+        'max_instance_class': None,
+        'max_readers': MAX_READERS,
+    }
+
+
+def read_json_setting(value):
+    """
+    parse a setting given as a JSON document or the path to a JSON file
+    """
+    if value.lstrip().startswith(('{', '[')):
+        return json.loads(value)
+    with open(value, encoding='utf-8') as setting_file:
+        return json.load(setting_file)
+
+
+def load_fleet_config():
+    """
+    load the per-cluster settings index of the fleet mode (once per container):
+    {"defaults": {...}, "clusters": {"<cluster>": {...}}} with the default_cluster_config() keys
+    """
+    global _fleet_config  # pylint: disable=global-statement
+    if _fleet_config is None:
+        fleet_config = read_json_setting(FLEET_CONFIG)
+        defaults = default_cluster_config()
+        defaults.update(fleet_config.get('defaults', {}))
+        _fleet_config = {name: dict(defaults, **config) for name, config in fleet_config.get('clusters', {}).items()}
+    return _fleet_config
+
+
+def get_cluster_config(cluster_name):
+    """
+    get the settings of the cluster (None if the cluster is not a part of the fleet)
+    """
+    if FLEET_CONFIG:
+        return load_fleet_config().get(cluster_name)
+    return default_cluster_config()
+
+
+def send_sns_alert(message):
+    """
+    SNS alerting
+    """
+    try:
+        get_client('sns').publish(
+            TopicArn=sns_topic_arn,
+            Message=message
+        )
+        print(f"SNS alert sent. Message: {message}")
+    except ClientError as e:
+        print(f"Failed to send an SNS alert. Error: {e}")
+
+
+def instance_type_sorter(instance_type, size_order=None):
+    """
+    instance type sorter
+    """
+    if size_order is None:
+        size_order = SIZE_ORDER
+    return size_order.index(instance_type) if instance_type in size_order else -1
+
+
+def metric_snapshot(instance_identifiers, metric_names, period=READER_LOAD_PERIOD):
+    """
+    get the latest metric values of the instances in one request ({instance: {metric: value}}, None on error)
+    """
+    queries = []
+    for instance_index, instance_identifier in enumerate(instance_identifiers):
+        for metric_index, metric_name in enumerate(metric_names):
+            queries.append({
+                'Id': f"m{instance_index}_{metric_index}",
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/RDS',
+                        'MetricName': metric_name,
+                        'Dimensions': [{'Name': 'DBInstanceIdentifier', 'Value': instance_identifier}],
+                    },
+                    'Period': period,
+                    'Stat': 'Average',
+                },
+            })
+    now = datetime.now(timezone.utc)
+    try:
+        response = get_client('cloudwatch').get_metric_data(
+            MetricDataQueries=queries,
+            StartTime=now - timedelta(seconds=2 * period),
+            EndTime=now,
+            ScanBy='TimestampDescending'
+        )
+    except ClientError as e:
+        print(f"Failed to get the metrics of the instances. Error: {e}")
+        return None
+    # The latest datapoint of every query
+    values = {result['Id']: result['Values'][0] for result in response['MetricDataResults'] if result['Values']}
+    snapshot = {}
+    for instance_index, instance_identifier in enumerate(instance_identifiers):
+        snapshot[instance_identifier] = {
+            metric_name: values[f"m{instance_index}_{metric_index}"]
+            for metric_index, metric_name in enumerate(metric_names) if f"m{instance_index}_{metric_index}" in values
+        }
+    return snapshot
+
+
+def least_loaded_instance(instance_identifiers):
+    """
+    pick the instance with the lowest load (a random one without the metrics)
+    """
+    if READER_SELECTION != "load" or len(instance_identifiers) <= 1:
+        return random.choice(instance_identifiers)
+    snapshot = metric_snapshot(instance_identifiers, READER_LOAD_METRICS)
+    if not snapshot or not any(snapshot.values()):
+        print("No load metrics of the readers, picking one at random.")
+        return random.choice(instance_identifiers)
+    loads = dict.fromkeys(instance_identifiers, 0.0)
+    for metric_name in READER_LOAD_METRICS:
+        peak = max(snapshot[instance_identifier].get(metric_name, 0.0) for instance_identifier in instance_identifiers)
+        if peak > 0:
+            for instance_identifier in instance_identifiers:
+                loads[instance_identifier] += snapshot[instance_identifier].get(metric_name, 0.0) / peak
+    print("Reader load: " + ", ".join(f"{instance_identifier}={load:.2f}" for instance_identifier, load in loads.items()))
+    lowest = min(loads.values())
+    return random.choice([instance_identifier for instance_identifier, load in loads.items() if load == lowest])
+
+
+def cluster_is_busy(instance_identifiers):
+    """
+    check if the CPU utilization of any instance is at SCALE_IN_CPU_PERCENT or above
+    """
+    snapshot = metric_snapshot(instance_identifiers, ["CPUUtilization"])
+    if not snapshot:
+        print("No CPU utilization of the instances, assuming the cluster is not busy.")
+        return False
+    busy = {instance_identifier: metrics['CPUUtilization'] for instance_identifier, metrics in snapshot.items()
+            if metrics.get('CPUUtilization', 0.0) >= SCALE_IN_CPU_PERCENT}
+    if busy:
+        print("Busy instances: " + ", ".join(f"{instance_identifier}={cpu:.1f}%" for instance_identifier, cpu in busy.items()))
+    return bool(busy)
+
+
+def get_instance_details(client, instance_identifier):
+    """
+    get the instance details
+    """
+    try:
+        response = client.describe_db_instances(DBInstanceIdentifier=instance_identifier)
+        instance_info = response['DBInstances'][0]
+        instance_class = instance_info['DBInstanceClass']
+        cluster_identifier = instance_info.get('DBClusterIdentifier', None)
+        return instance_class, cluster_identifier
+    except ClientError as e:
+        error_message = f"Error getting the DB instance details: {e}"
+        print(error_message)
+        send_sns_alert(error_message)
+        return None, None
+
+
+def get_instance_arn(client, instance_identifier):
+    """
+    get the instance arn
+    """
+    try:
+        instance_info = client.describe_db_instances(DBInstanceIdentifier=instance_identifier)
+        return instance_info['DBInstances'][0]['DBInstanceArn']
+    except ClientError as e:
+        error_message = f"Error getting the instance ARN for {instance_identifier}: {e}"
+        print(error_message)
+        send_sns_alert(error_message)
+        return None
+
+
+def any_member_modifying(client, cluster_members):
+    """
+    checking if any cluster instance is being modified already
+    """
+    for member in cluster_members:
+        instance_info = client.describe_db_instances(DBInstanceIdentifier=member['DBInstanceIdentifier'])
+        if instance_info['DBInstances'][0]['DBInstanceStatus'] in MODIFYING_STATUSES:
+            return True
+    return False
+
+
+def any_instance_has_modifying_tag(client, cluster_instances):
+    """
+    check if the modifying tag exists
+    """
+    for member in cluster_instances:
+        instance_arn = get_instance_arn(client, member['DBInstanceIdentifier'])
+        tags = client.list_tags_for_resource(ResourceName=instance_arn)['TagList']
+        if any(tag['Key'] == 'modifying' for tag in tags):
+            return True
+    return False
+
+
+def modification_timestamps(client, cluster_instances, cooldown_period):
+    """
+    modification timestamps workflow
+    """
+    now = datetime.now(timezone.utc)
+    expired_instances = []
+    cooldown_not_expired = False
+
+    for member in cluster_instances:
+        instance_identifier = member['DBInstanceIdentifier']
+        instance_arn = get_instance_arn(client, instance_identifier)
+        tags = client.list_tags_for_resource(ResourceName=instance_arn)['TagList']
+
+        for tag in tags:
+            if tag['Key'] == 'modificationTimestamp':
+                tag_timestamp = datetime.fromisoformat(tag['Value'])
+                time_diff_seconds = (now - tag_timestamp).total_seconds()
+                cooldown_seconds = timedelta(seconds=cooldown_period).total_seconds()
+
+                if time_diff_seconds >= cooldown_seconds:
+                    expired_instances.append(instance_identifier)
+                else:
+                    cooldown_not_expired = True
+
+    for instance_identifier in expired_instances:
+        instance_arn = get_instance_arn(client, instance_identifier)
+        client.remove_tags_from_resource(
+            ResourceName=instance_arn,
+            TagKeys=['modificationTimestamp']
+        )
+
+    return cooldown_not_expired
+
+
+def find_failover_target(client, cluster_members, new_instance_type, size_order=None):
+    """
+    find the smallest reader which is already of the new writer size (or bigger) to promote
+    """
+    failover_target, failover_target_index = None, None
+    for member in cluster_members:
+        if member['IsClusterWriter']:
+            continue
+        instance_info = client.describe_db_instances(DBInstanceIdentifier=member['DBInstanceIdentifier'])['DBInstances'][0]
+        member_index = instance_type_sorter(instance_info['DBInstanceClass'], size_order)
+        if member_index < instance_type_sorter(new_instance_type, size_order):
+            continue
+        if failover_target_index is None or member_index < failover_target_index:
+            failover_target, failover_target_index = instance_info, member_index
+    return failover_target
+
+
+def change_instance_type(client, instance_identifier, new_instance_type):
+    """
+    change the instance type
+    """
+    try:
+        response = client.modify_db_instance(
+            DBInstanceIdentifier=instance_identifier,
+            DBInstanceClass=new_instance_type,
+            ApplyImmediately=True
+        )
+        return response, None
+    except ClientError as e:
+        error_message = f"Error during an attempt to vertically scale the RDS instance {e}"
+        print(error_message)
+        send_sns_alert(error_message)
+        return None, str(e)
+
+
+def failover_to_reader(client, cluster_identifier, reader_identifier):
+    """
+    promote the reader to the writer role
+    """
+    try:
+        response = client.failover_db_cluster(
+            DBClusterIdentifier=cluster_identifier,
+            TargetDBInstanceIdentifier=reader_identifier
+        )
+        return response, None
+    except ClientError as e:
+        error_message = f"Error during an attempt to fail over the RDS cluster to {reader_identifier}: {e}"
+        print(error_message)
+        send_sns_alert(error_message)
+        return None, str(e)
+
+
+def replica_identifier_prefix(cluster_identifier):
+    """
+    identifier prefix of the replicas added by the horizontal scaling (instance identifiers are 63 characters at most)
+    """
+    return f"{cluster_identifier[:37]}-autoscaled-"
+
+
+def new_replica_identifier(cluster_identifier):
+    """
+    identifier of a new replica of the cluster
+    """
+    return replica_identifier_prefix(cluster_identifier) + datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+
+
+def create_reader_replica(client, cluster_identifier, instance_identifier, source_identifier, instance_class):
+    """
+    add a reader of the instance class to the cluster, with the engine, parameter group and tags of the source instance
+    """
+    try:
+        source = client.describe_db_instances(DBInstanceIdentifier=source_identifier)['DBInstances'][0]
+        tags = client.list_tags_for_resource(ResourceName=source['DBInstanceArn'])['TagList']
+        # The state of the source's own modifications (and of the schedule) isn't copied
+        tags = [tag for tag in tags if tag['Key'] not in ('modifying', 'modificationTimestamp', 'autoscaled',
+                                                         'scheduled', 'scheduledFrom', 'scheduledClass')
+                and not tag['Key'].startswith('aws:')]
+        tags.append({'Key': 'autoscaled', 'Value': 'true'})
+        options = {}
+        if source.get('DBParameterGroups'):
+            options['DBParameterGroupName'] = source['DBParameterGroups'][0]['DBParameterGroupName']
+        response = client.create_db_instance(
+            DBInstanceIdentifier=instance_identifier,
+            DBInstanceClass=instance_class,
+            Engine=source['Engine'],
+            DBClusterIdentifier=cluster_identifier,
+            # The replicas added by the autoscaler are the last ones to be promoted on a failover
+            PromotionTier=15,
+            Tags=tags,
+            **options
+        )
+        return response, None
+    except ClientError as e:
+        error_message = f"Error during an attempt to add the reader instance {instance_identifier}: {e}"
+        print(error_message)
+        send_sns_alert(error_message)
+        return None, str(e)
+
+
+def delete_reader_replica(client, instance_identifier):
+    """
+    delete a reader instance of the cluster
+    """
+    try:
+        response = client.delete_db_instance(DBInstanceIdentifier=instance_identifier)
+        return response, None
+    except ClientError as e:
+        error_message = f"Error during an attempt to delete the reader instance {instance_identifier}: {e}"
+        print(error_message)
+        send_sns_alert(error_message)
+        return None, str(e)
+
+
+def add_modifying_tag(client, instance_identifier, modifying=True):
+    """
+    add the modifying tag and timestamp to prevent simultaneous actions at the same time (only the timestamp,
+    which starts the cooldown, if the instance itself isn't modified)
+    """
+    instance_arn = get_instance_arn(client, instance_identifier)
+    if not instance_arn:
+        print(f"ARN not found for the instance {instance_identifier}")
+        return
+    timestamp = datetime.now(timezone.utc).isoformat()
+    tags = [{'Key': 'modificationTimestamp', 'Value': timestamp}]
+    if modifying:
+        tags.insert(0, {'Key': 'modifying', 'Value': 'true'})
+    try:
+        client.add_tags_to_resource(
+            ResourceName=instance_arn,
+            Tags=tags
+        )
+        print(f"Added the {'modifying' if modifying else 'modificationTimestamp'} tag to instance {instance_identifier}")
+    except ClientError as e:
+        error_message = f"Error adding the 'modifying' tag to {instance_identifier}: {e}"
+        print(error_message)
+        send_sns_alert(error_message)
+
+
+def remove_tag_from_instance(client, instance_identifier, tag_key):
+    """
+    remove the tag from the instance
+    """
+    instance_arn = get_instance_arn(client, instance_identifier)
+    if not instance_arn:
+        print(f"ARN not found for the instance {instance_identifier}")
+        return
+    client.remove_tags_from_resource(ResourceName=instance_arn, TagKeys=[tag_key])
@@ -0,0 +1,124 @@
+"""
+Choice of the instance class to scale up to, based on what limits the instance.
+
+A snapshot of the CPUUtilization, FreeableMemory, BufferCacheHitRatio and
+DatabaseConnections metrics of the instance whose alarm fired classifies its
+bottleneck:
+* memory: little freeable memory left or a low buffer cache hit ratio;
+* connections: the connections are close to the default max_connections of
+  the class (which depends on its memory);
+* cpu: otherwise, or if the CPU is busy anyway.
+The target is then looked up in the instance catalog (vCPUs and memory of
+every class) among the classes following the current one in SIZE_ORDER: the
+first one with more vCPUs for the CPU, the one with more memory and the
+fewest vCPUs (e.g. db.x2g rather than the next db.r6g size) for the memory
+and the connections.
+"""
+import math
+import os
+from rds_vscale_core import metric_snapshot, read_json_setting
+
+# "metrics" picks the target class from the bottleneck, "cpu" always takes the next class in SIZE_ORDER
+SCALING_DECISION = os.environ.get("SCALING_DECISION", "metrics")
+# Extra or corrected catalog entries: {"<class>": {"vcpu": 2, "memory": 16}}, a JSON document or the path to a JSON file
+INSTANCE_CATALOG = os.environ.get("INSTANCE_CATALOG")
+CPU_HIGH_PERCENT = float(os.environ.get("CPU_HIGH_PERCENT", "70"))
+FREEABLE_MEMORY_LOW_RATIO = float(os.environ.get("FREEABLE_MEMORY_LOW_RATIO", "0.1"))
+BUFFER_CACHE_HIT_LOW_PERCENT = float(os.environ.get("BUFFER_CACHE_HIT_LOW_PERCENT", "95"))
+CONNECTIONS_HIGH_RATIO = float(os.environ.get("CONNECTIONS_HIGH_RATIO", "0.8"))
+DECISION_METRICS = ["CPUUtilization", "FreeableMemory", "BufferCacheHitRatio", "DatabaseConnections"]
+MEMORY_METRICS = ["FreeableMemory", "BufferCacheHitRatio"]
+
+# vCPUs of the sizes and memory (GiB) per vCPU of the families supported by Aurora
+SIZE_VCPUS = {'large': 2, 'xlarge': 4, '2xlarge': 8, '4xlarge': 16, '8xlarge': 32, '12xlarge': 48,
+              '16xlarge': 64, '24xlarge': 96, '32xlarge': 128}
+FAMILY_MEMORY_PER_VCPU = {'r5': 8, 'r6g': 8, 'r6i': 8, 'r7g': 8, 'r7i': 8, 'r8g': 8, 'x2g': 16}
+BURSTABLE_CLASSES = {'db.t3.medium': (2, 4), 'db.t3.large': (2, 8), 'db.t4g.medium': (2, 4), 'db.t4g.large': (2, 8)}
+
+_catalog = None
+
+
+def get_instance_catalog():
+    """
+    vCPUs and memory (GiB) of the instance classes: the built-in ones updated with INSTANCE_CATALOG
+    """
+    global _catalog  # pylint: disable=global-statement
+    if _catalog is None:
+        catalog = {f"db.{family}.{size}": {'vcpu': vcpu, 'memory': vcpu * memory_per_vcpu}
+                   for family, memory_per_vcpu in FAMILY_MEMORY_PER_VCPU.items() for size, vcpu in SIZE_VCPUS.items()}
+        catalog.update({instance_class: {'vcpu': vcpu, 'memory': memory}
+                        for instance_class, (vcpu, memory) in BURSTABLE_CLASSES.items()})
+        if INSTANCE_CATALOG:
+            catalog.update(read_json_setting(INSTANCE_CATALOG))
+        _catalog = catalog
+    return _catalog
+
+
+def max_connections(instance_class, engine):
+    """
+    the default max_connections of the class (the formulas of the default Aurora parameter groups)
+    """
+    memory = get_instance_catalog()[instance_class]['memory'] * 1024 ** 3
+    if engine and 'mysql' in engine:
+        return max(math.log2(memory / 805306368) * 45, math.log2(memory / 8187281408) * 1000)
+    return min(memory / 9531392, 5000)
+
+
+def classify_bottleneck(metrics, instance_class, engine, trigger_metric=None):
+    """
+    classify what limits the instance from its metrics (and the metric of the alarm): 'cpu', 'memory' or 'connections'
+    """
+    catalog = get_instance_catalog()
+    if instance_class not in catalog:
+        return 'cpu'
+    memory_pressure = trigger_metric in MEMORY_METRICS
+    if 'FreeableMemory' in metrics:
+        memory_pressure |= metrics['FreeableMemory'] < FREEABLE_MEMORY_LOW_RATIO * catalog[instance_class]['memory'] * 1024 ** 3
+    if 'BufferCacheHitRatio' in metrics:
+        memory_pressure |= metrics['BufferCacheHitRatio'] < BUFFER_CACHE_HIT_LOW_PERCENT
+    connections_pressure = trigger_metric == 'DatabaseConnections'
+    if 'DatabaseConnections' in metrics:
+        connections_pressure |= metrics['DatabaseConnections'] >= CONNECTIONS_HIGH_RATIO * max_connections(instance_class, engine)
+    cpu_pressure = metrics.get('CPUUtilization', 0) >= CPU_HIGH_PERCENT
+    if memory_pressure and not cpu_pressure:
+        return 'memory'
+    if connections_pressure and not cpu_pressure:
+        return 'connections'
+    return 'cpu'
+
+
+def choose_target_class(current_class, bottleneck, size_order, max_size_index, preferred=None):
+    """
+    choose the next class which relieves the bottleneck, preferring the given classes
+    """
+    current_index = size_order.index(current_class)
+    candidates = size_order[current_index + 1:max_size_index + 1]
+    if not candidates:
+        return current_class
+    catalog = get_instance_catalog()
+    if bottleneck is None or any(instance_class not in catalog for instance_class in [current_class] + candidates):
+        return candidates[0]
+    current = catalog[current_class]
+    if bottleneck == 'cpu':
+        relieving = [candidate for candidate in candidates if catalog[candidate]['vcpu'] > current['vcpu']]
+    else:
+        relieving = [candidate for candidate in candidates if catalog[candidate]['memory'] > current['memory']]
+        # The fewest vCPUs for the memory, i.e. the memory optimized class
+        relieving.sort(key=lambda candidate: (catalog[candidate]['vcpu'], size_order.index(candidate)))
+    relieving_preferred = sorted((candidate for candidate in relieving if candidate in (preferred or ())), key=size_order.index)
+    if relieving_preferred:
+        return relieving_preferred[0]
+    return relieving[0] if relieving else candidates[0]
+
+
+def detect_bottleneck(instance_identifier, instance_class, engine, trigger_metric=None):
+    """
+    the bottleneck of the instance whose alarm fired (None with SCALING_DECISION=cpu)
+    """
+    if SCALING_DECISION != "metrics":
+        return None
+    snapshot = metric_snapshot([instance_identifier], DECISION_METRICS) or {}
+    metrics = snapshot.get(instance_identifier, {})
+    bottleneck = classify_bottleneck(metrics, instance_class, engine, trigger_metric)
+    print(f"Metrics of {instance_identifier}: {metrics}, bottleneck: {bottleneck}")
+    return bottleneck
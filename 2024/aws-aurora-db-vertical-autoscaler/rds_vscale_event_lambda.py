@@ -1,103 +1,237 @@
 import json
 import os
-import random
-from datetime import datetime, timezone
-import boto3
-from botocore.exceptions import ClientError
-
-size_order_str = os.environ.get("SIZE_ORDER", "[]")
-SIZE_ORDER = json.loads(size_order_str)
-MODIFYING_STATUSES = ["modifying", "storage-optimization", "creating"]
-
-rds_client = boto3.client('rds')
-sns_client = boto3.client('sns')
-sns_topic_arn = os.environ.get('ALARMS_SNS')
-
+from functools import partial
+from rds_vscale_core import (
+    FLEET_CONFIG, get_client, send_sns_alert, instance_type_sorter, any_member_modifying, remove_tag_from_instance,
+    instrumented, record_decision, get_cluster_config, map_concurrently, cluster_metrics, least_loaded_instance, find_failover_target,
+    load_fleet_config, replica_identifier_prefix
+)
+from rds_vscale_lock import get_lock_store, start_resize, start_failover
+
+EVENT_CLASS_CHANGED = 'http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/USER_Events.Messages.html#RDS-EVENT-0014'
+EVENT_FAILOVER_COMPLETED = 'http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/USER_Events.Messages.html#RDS-EVENT-0071'
+EVENT_INSTANCE_CREATED = 'http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/USER_Events.Messages.html#RDS-EVENT-0005'
+EVENT_INSTANCE_DELETED = 'http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/USER_Events.Messages.html#RDS-EVENT-0003'
+
+@instrumented("event")
 def lambda_handler(event, _):
     """
     lambda function triggered by rds event
     """
     print("Received event:", event)
-    # Process JSON
-    sns_message = json.loads(event['Records'][0]['Sns']['Message'])
-    print("SNS message:", sns_message)
-    cluster_name = sns_message.get('Tags', {}).get('Cluster', None)
-    print("Cluster name:", cluster_name)
-    expected_cluster_name = os.environ['CLUSTER_NAME']
-    if cluster_name != expected_cluster_name:
-        print(f"Ignoring event for cluster: {cluster_name}")
-        return
-
-    if sns_message['Event ID'] != 'http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/USER_Events.Messages.html#RDS-EVENT-0014':
+    rds_client = get_client('rds')
+    lock_store = get_lock_store()
+    # Process JSON, grouping the messages by cluster
+    cluster_messages = {}
+    for record in event['Records']:
+        sns_message = json.loads(record['Sns']['Message'])
+        print("SNS message:", sns_message)
+        cluster_name = sns_message.get('Tags', {}).get('Cluster', None)
+        if cluster_name is None and sns_message.get('Event ID') == EVENT_FAILOVER_COMPLETED:
+            # Cluster events are not tagged by the instance tags, the source is the cluster itself
+            cluster_name = sns_message.get('Source ID')
+        print("Cluster name:", cluster_name)
+        # The tag only filters the messages, the settings are looked up by the cluster identifier once it's resolved
+        # (fleet mode: any tagged cluster, the ones out of the config index are ignored then)
+        if cluster_name is None or (not FLEET_CONFIG and cluster_name != os.environ['CLUSTER_NAME']):
+            print(f"Ignoring event for cluster: {cluster_name}")
+            record_decision("ignored")
+            continue
+        cluster_messages.setdefault(cluster_name, []).append(sns_message)
+
+    failures = []
+
+    def process_cluster(cluster_name):
+        # The messages of a cluster are handled one by one, different clusters concurrently
+        with cluster_metrics(cluster_name, len(cluster_messages) > 1):
+            for sns_message in cluster_messages[cluster_name]:
+                try:
+                    process_rds_event(rds_client, lock_store, sns_message)
+                except Exception as e:  # pylint: disable=broad-except
+                    error_message = f"Failed to process the event for cluster {cluster_name}. Error: {e}"
+                    print(error_message)
+                    send_sns_alert(error_message)
+                    record_decision("failed", ClusterIdentifier=cluster_name)
+                    failures.append(e)
+
+    map_concurrently(process_cluster, list(cluster_messages))
+    # Raised once every cluster is processed, whatever the number of clusters in the batch
+    if failures:
+        raise failures[0]
+
+
+def process_rds_event(rds_client, lock_store, sns_message):
+    """
+    scale the next instance of the cluster after the rds event
+    """
+    if sns_message['Event ID'] not in (EVENT_CLASS_CHANGED, EVENT_FAILOVER_COMPLETED,
+                                       EVENT_INSTANCE_CREATED, EVENT_INSTANCE_DELETED):
         print(f"Ignoring event with ID: {sns_message['Event ID']}")
+        record_decision("ignored")
         return
 
     if 'Source ID' not in sns_message:
         print("Source ID not found in SNS message")
         return
 
-    instance_identifier = sns_message['Source ID']
-
-    # Get the cluster and instance info
-    instance_info = rds_client.describe_db_instances(DBInstanceIdentifier=instance_identifier)
-    if 'DBClusterIdentifier' not in instance_info['DBInstances'][0]:
-        print(f"Instance {instance_identifier} is not a part of the cluster.")
+    source_identifier = sns_message['Source ID']
+    if sns_message['Event ID'] == EVENT_INSTANCE_DELETED:
+        # A reader added by the horizontal scaling was removed; the instance can't be described any more,
+        # the cluster is known from its identifier
+        cluster_identifier = deleted_replica_cluster(source_identifier)
+        print(f"The reader instance {source_identifier} was deleted.")
+        if lock_store and cluster_identifier:
+            lock_store.release(cluster_identifier, source_identifier)
+        record_decision("completed", ClusterIdentifier=cluster_identifier, InstanceIdentifier=source_identifier)
         return
-
-    cluster_identifier = instance_info['DBInstances'][0]['DBClusterIdentifier']
+    if sns_message['Event ID'] == EVENT_FAILOVER_COMPLETED:
+        cluster_identifier = sns_message['Source ID']
+    else:
+        instance_identifier = sns_message['Source ID']
+
+        # Get the cluster and instance info
+        instance_info = rds_client.describe_db_instances(DBInstanceIdentifier=instance_identifier)
+        if 'DBClusterIdentifier' not in instance_info['DBInstances'][0]:
+            print(f"Instance {instance_identifier} is not a part of the cluster.")
+            return
+
+        cluster_identifier = instance_info['DBInstances'][0]['DBClusterIdentifier']
+    cluster_config = get_cluster_config(cluster_identifier)
+    if cluster_config is None:
+        print(f"Ignoring event for cluster: {cluster_identifier}")
+        record_decision("ignored", ClusterIdentifier=cluster_identifier)
+        return
+    size_order = cluster_config['size_order']
     cluster_info = rds_client.describe_db_clusters(DBClusterIdentifier=cluster_identifier)
     cluster_members = cluster_info['DBClusters'][0]['DBClusterMembers']
 
+    # Modifications made by the schedule lambda are not propagated, it continues with the next instance itself
+    if sns_message.get('Tags', {}).get('scheduled') == 'true':
+        complete_scheduled_modification(rds_client, lock_store, sns_message, cluster_identifier, cluster_members)
+        return
+
     # If modifying?
     if any_member_modifying(rds_client, cluster_members):
         print("An instance in the cluster is currently being modified.")
+        record_decision("modifying-skipped", ClusterIdentifier=cluster_identifier)
         return
 
     # Get the cluster status
     if is_cluster_modifying(rds_client, cluster_identifier):
         print("The cluster is currently in the modifying state.")
+        record_decision("modifying-skipped", ClusterIdentifier=cluster_identifier)
         return
 
-    # Search for the 'modifying' tag
-    handle_modifying_tag(rds_client, cluster_members)
+    # Search for the 'modifying' tag (the lock store replaces the tags)
+    if lock_store is None:
+        handle_modifying_tag(rds_client, cluster_members)
     # Search for largest instance type in the cluster
-    largest_instance_type = find_largest_instance_type(rds_client, cluster_members)
+    largest_instance_type = find_largest_instance_type(rds_client, cluster_members, size_order)
     print(f"The largest instance type in the cluster is {largest_instance_type}.")
+    max_instance_class = cluster_config.get('max_instance_class')
+    if max_instance_class and instance_type_sorter(largest_instance_type, size_order) > instance_type_sorter(max_instance_class, size_order):
+        print(f"The instances are scaled up to the maximum instance type of the cluster {max_instance_class} only.")
+        largest_instance_type = max_instance_class
 
+    # The lock is passed on from the modification completed by the event
+    take_lock = partial(hand_over_lock, source_identifier=source_identifier)
     writer_instance = find_writer_instance(rds_client, cluster_members)
-    eligible_readers = find_eligible_readers_for_scale_up(rds_client, cluster_members, largest_instance_type)
+    eligible_readers = find_eligible_readers_for_scale_up(rds_client, cluster_members, largest_instance_type, size_order)
 
     # Check and scale the writer
-    if writer_instance and writer_instance['DBInstanceClass'] != largest_instance_type:
+    if writer_instance and writer_instance['DBInstanceClass'] != largest_instance_type \
+            and instance_type_sorter(writer_instance['DBInstanceClass'], size_order) < instance_type_sorter(largest_instance_type, size_order):
+        failover_target = None
+        if cluster_config['writer_scale_strategy'] == "failover":
+            failover_target = find_failover_target(rds_client, cluster_members, largest_instance_type, size_order)
+        if failover_target:
+            # The old writer becomes a reader and is scaled up after the failover is completed
+            acquired, error = start_failover(rds_client, lock_store, cluster_identifier, writer_instance['DBInstanceIdentifier'],
+                                             failover_target['DBInstanceIdentifier'], cluster_config['cooldown'], take_lock)
+            if not acquired:
+                return
+            if not error:
+                message = f"Failing over the writer role from {writer_instance['DBInstanceIdentifier']} to {failover_target['DBInstanceIdentifier']}"
+                print(message)
+                send_sns_alert(message)
+            record_decision("failed" if error else "writer-up", writer_instance['DBInstanceClass'], largest_instance_type,
+                            ClusterIdentifier=cluster_identifier,
+                            InstanceIdentifier=failover_target['DBInstanceIdentifier'], Strategy="failover")
+            return
+        writer_strategy = "modify"
         message = f"Scaling up the writer instance: {writer_instance['DBInstanceIdentifier']}"
-        print(message)
-        send_sns_alert(message)
-        scale_instance(rds_client, writer_instance['DBInstanceIdentifier'], largest_instance_type)
-        add_modifying_tag(rds_client, writer_instance['DBInstanceIdentifier'])
+        if cluster_config['writer_scale_strategy'] == "failover":
+            writer_strategy = "modify-fallback"
+            message += f" in place, there is no reader of the type {largest_instance_type} to fail over to"
+        acquired, error = start_resize(rds_client, lock_store, cluster_identifier, writer_instance['DBInstanceIdentifier'],
+                                       largest_instance_type, cluster_config['cooldown'], take_lock)
+        if not acquired:
+            return
+        if not error:
+            print(message)
+            send_sns_alert(message)
+        record_decision("failed" if error else "writer-up", writer_instance['DBInstanceClass'], largest_instance_type,
+                        ClusterIdentifier=cluster_identifier,
+                        InstanceIdentifier=writer_instance['DBInstanceIdentifier'], Strategy=writer_strategy)
         return
 
     # Check and scale the readers
     if eligible_readers:
-        instance_to_scale_up = select_random_instance(eligible_readers)
-        message = f"Scaling up the reader instance: {instance_to_scale_up['DBInstanceIdentifier']}"
-        print(message)
-        send_sns_alert(message)
-        scale_instance(rds_client, instance_to_scale_up['DBInstanceIdentifier'], largest_instance_type)
-        add_modifying_tag(rds_client, instance_to_scale_up['DBInstanceIdentifier'])
+        instance_to_scale_up = select_least_loaded_instance(eligible_readers)
+        acquired, error = start_resize(rds_client, lock_store, cluster_identifier, instance_to_scale_up['DBInstanceIdentifier'],
+                                       largest_instance_type, cluster_config['cooldown'], take_lock)
+        if not acquired:
+            return
+        if not error:
+            message = f"Scaling up the reader instance: {instance_to_scale_up['DBInstanceIdentifier']}"
+            print(message)
+            send_sns_alert(message)
+        record_decision("failed" if error else "reader-up", instance_to_scale_up['DBInstanceClass'], largest_instance_type,
+                        ClusterIdentifier=cluster_identifier,
+                        InstanceIdentifier=instance_to_scale_up['DBInstanceIdentifier'])
         return
     print("No scaling actions required at this time.")
+    if lock_store:
+        lock_store.release(cluster_identifier, source_identifier)
+    record_decision("completed", largest_instance_type, largest_instance_type, ClusterIdentifier=cluster_identifier)
     send_sns_alert("The process of modifying instances in the cluster using a Lambda function has been completed.")
 
 
-def any_member_modifying(client, cluster_members):
+def deleted_replica_cluster(instance_identifier):
     """
-    checking if any cluster instance is being modified already
+    find the cluster of a deleted replica by the prefix of its identifier
     """
-    for member in cluster_members:
-        instance_info = client.describe_db_instances(DBInstanceIdentifier=member['DBInstanceIdentifier'])
-        if instance_info['DBInstances'][0]['DBInstanceStatus'] in MODIFYING_STATUSES:
-            return True
-    return False
+    clusters = load_fleet_config() if FLEET_CONFIG else [os.environ['CLUSTER_NAME']]
+    return next((cluster_identifier for cluster_identifier in clusters
+                 if instance_identifier.startswith(replica_identifier_prefix(cluster_identifier))), None)
+
+
+def complete_scheduled_modification(client, lock_store, sns_message, cluster_identifier, cluster_members):
+    """
+    clear the tags (or release the lock) of a modification made by the schedule lambda
+    """
+    source_identifier = sns_message['Source ID']
+    print(f"The scheduled modification of {source_identifier} is completed.")
+    if 'Source ARN' in sns_message:
+        client.remove_tags_from_resource(ResourceName=sns_message['Source ARN'], TagKeys=['scheduled'])
+    if lock_store:
+        lock_store.release(cluster_identifier, source_identifier)
+    else:
+        handle_modifying_tag(client, cluster_members)
+    record_decision("completed", ClusterIdentifier=cluster_identifier, InstanceIdentifier=source_identifier)
+
+
+def hand_over_lock(lock_store, cluster_identifier, source_identifier, owner):
+    """
+    pass the scaling lock from the completed modification to the next one (no-op without a lock store)
+    """
+    if lock_store is None:
+        return True
+    acquired, _ = lock_store.hand_over(cluster_identifier, source_identifier, owner)
+    if not acquired:
+        print("Another modification holds the scaling lock of the cluster.")
+        record_decision("modifying-skipped", ClusterIdentifier=cluster_identifier)
+    return acquired
 
 def find_instances_of_type(client, cluster_members, instance_type):
     """
@@ -119,35 +253,7 @@ def is_cluster_modifying(client, cluster_identifier):
     modifying_statuses = ["modifying", "failing-over", "storage-optimization"]
     return cluster_status.lower() in modifying_statuses
 
-def scale_instance(client, instance_identifier, new_instance_type):
-    """
-    scale the instance
-    """
-    try:
-        if new_instance_type is None:
-            # If the next instance type is not found, remove the 'modifying' tag and do not proceed with scaling
-            print(f"No suitable next instance type found for {instance_identifier}. Removing the 'modifying' tag.")
-            remove_tag_from_instance(rds_client, instance_identifier, 'modifying')
-            return False  # Scaling was not performed
-
-        # Continue performing the scaling if a new instance type is available
-        response = client.modify_db_instance(
-            DBInstanceIdentifier=instance_identifier,
-            DBInstanceClass=new_instance_type,
-            ApplyImmediately=True
-        )
-        print(f"Instance scaling response: {response}")
-        return True  # Scaling was successfully initiated
-    except ClientError as e:
-        error_message = f"Error during the instance scaling: {e}"
-        print(error_message)
-        send_sns_alert(error_message)
-        # In case of a scaling error, also remove the 'modifying' tag
-        remove_tag_from_instance(client, instance_identifier, 'modifying')
-        return False  # Scaling was not performed
-
-
-def find_largest_instance_type(client, cluster_members):
+def find_largest_instance_type(client, cluster_members, size_order=None):
     """
     find the largest instance type (its size will be used for each instance in cluster)
     """
@@ -157,7 +263,7 @@ def find_largest_instance_type(client, cluster_members):
         instance_info = client.describe_db_instances(DBInstanceIdentifier=member['DBInstanceIdentifier'])
         instance_type = instance_info['DBInstances'][0]['DBInstanceClass']
 
-        if largest_instance_type is None or instance_type_sorter(instance_type) > instance_type_sorter(largest_instance_type):
+        if largest_instance_type is None or instance_type_sorter(instance_type, size_order) > instance_type_sorter(largest_instance_type, size_order):
             largest_instance_type = instance_type
 
     return largest_instance_type
@@ -172,7 +278,7 @@ def find_writer_instance(client, cluster_members):
             return instance_info['DBInstances'][0]
     return None
 
-def find_eligible_readers_for_scale_up(client, cluster_members, largest_instance_type):
+def find_eligible_readers_for_scale_up(client, cluster_members, largest_instance_type, size_order=None):
     """
     find the eligible readers for scaling up
     """
@@ -184,58 +290,25 @@ def find_eligible_readers_for_scale_up(client, cluster_members, largest_instance
         if not member['IsClusterWriter']:
             instance_info = client.describe_db_instances(DBInstanceIdentifier=member['DBInstanceIdentifier'])
             instance_type = instance_info['DBInstances'][0]['DBInstanceClass']
-            if smallest_instance_type is None or instance_type_sorter(instance_type) < instance_type_sorter(smallest_instance_type):
+            if smallest_instance_type is None or instance_type_sorter(instance_type, size_order) < instance_type_sorter(smallest_instance_type, size_order):
                 smallest_instance_type = instance_type
 
 	# Choose the eligible readers
-    if smallest_instance_type and smallest_instance_type != largest_instance_type:
+    if smallest_instance_type and smallest_instance_type != largest_instance_type \
+            and instance_type_sorter(smallest_instance_type, size_order) < instance_type_sorter(largest_instance_type, size_order):
         for member in cluster_members:
             if not member['IsClusterWriter']:
-                instance_info = rds_client.describe_db_instances(DBInstanceIdentifier=member['DBInstanceIdentifier'])
+                instance_info = client.describe_db_instances(DBInstanceIdentifier=member['DBInstanceIdentifier'])
                 if instance_info['DBInstances'][0]['DBInstanceClass'] == smallest_instance_type:
                     eligible_readers.append(instance_info['DBInstances'][0])
     return eligible_readers
 
-def select_random_instance(eligible_readers):
-    """
-    select a random instance from eligible
-    """
-    return random.choice(eligible_readers)
-
-def instance_type_sorter(instance_type):
-    """
-    sorter
-    """
-    return SIZE_ORDER.index(instance_type) if instance_type in SIZE_ORDER else -1
-
-def add_modifying_tag(client, instance_identifier):
+def select_least_loaded_instance(eligible_readers):
     """
-    add the modifying tag and timestamp to prevent simultaneous actions at the same time
+    select the least loaded instance from eligible
     """
-    instance_arn = get_instance_arn(client, instance_identifier)
-    if not instance_arn:
-        print(f"ARN not found for the instance {instance_identifier}")
-        return
-    timestamp = datetime.now(timezone.utc).isoformat()
-    try:
-        client.add_tags_to_resource(
-            ResourceName=instance_arn,
-            Tags=[{'Key': 'modifying', 'Value': 'true'},
-                  {'Key': 'modificationTimestamp', 'Value': timestamp}
-                  ]
-        )
-        print(f"Added the 'modifying' tag to instance {instance_identifier}")
-    except ClientError as e:
-        error_messsage = f"Error adding the 'modifying' tag to {instance_identifier}: {e}"
-        print(error_messsage)
-        send_sns_alert(error_messsage)
-
-def get_instance_arn(client, instance_identifier):
-    """
-    get the instance arn
-    """
-    instance_info = client.describe_db_instances(DBInstanceIdentifier=instance_identifier)
-    return instance_info['DBInstances'][0]['DBInstanceArn']
+    instance_identifier = least_loaded_instance([reader['DBInstanceIdentifier'] for reader in eligible_readers])
+    return next(reader for reader in eligible_readers if reader['DBInstanceIdentifier'] == instance_identifier)
 
 def handle_modifying_tag(client, cluster_members):
     """
@@ -258,23 +331,3 @@ def find_instances_with_tag(client, cluster_members, tag_key):
         if any(t['Key'] == tag_key for t in tags['TagList']):
             instances_with_tag.append(instance_info['DBInstances'][0])
     return instances_with_tag
-
-def remove_tag_from_instance(client, instance_identifier, tag_key):
-    """
-    remove the modifying tag
-    """
-    instance_arn = get_instance_arn(client, instance_identifier)
-    rds_client.remove_tags_from_resource(ResourceName=instance_arn, TagKeys=[tag_key])
-
-def send_sns_alert(message):
-    """
-    SNS alerting
-    """
-    try:
-        sns_client.publish(
-            TopicArn=sns_topic_arn,
-            Message=message
-        )
-        print(f"SNS alert sent. Message: {message}")
-    except ClientError as e:
-        print(f"Failed to send an SNS alert. Error: {e}")
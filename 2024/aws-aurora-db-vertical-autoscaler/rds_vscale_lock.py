@@ -0,0 +1,190 @@
+"""
+Per-cluster scaling lock and cooldown kept in a DynamoDB table.
+
+The table (its name is set in LOCK_TABLE) has the ClusterIdentifier string
+partition key and an item per cluster holding:
+* LeaseOwner, LeaseExpires: the lease of the modification in progress. The
+  owner is the resource whose RDS event completes it: the instance being
+  modified or the cluster being failed over.
+* CooldownUntil: the time new scale-ups are allowed again, i.e. the start
+  of the last modification plus MODIFY_COOLDOWN_PERIOD. It is only set once
+  the RDS call has succeeded, so a modification that failed to start doesn't
+  hold off the next alarms.
+
+Every check-and-set is a single conditional UpdateItem, so concurrent
+invocations can't both take the lock. The lease expires by itself if the
+event completing the modification is lost.
+"""
+import os
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from rds_vscale_core import (
+    MODIFY_COOLDOWN_PERIOD, get_client, add_modifying_tag, record_decision, change_instance_type, failover_to_reader
+)
+
+
+LOCK_TABLE = os.environ.get("LOCK_TABLE")
+LOCK_LEASE_SECONDS = int(os.environ.get("LOCK_LEASE_SECONDS", "3600"))
+
+_lock_store = None
+
+
+class DynamoDBLockStore:
+    """
+    scaling lock and cooldown of the clusters in a DynamoDB table
+    """
+    def __init__(self, client, table_name):
+        self.client = client
+        self.table_name = table_name
+
+    def acquire(self, cluster_identifier, owner, lease_seconds=LOCK_LEASE_SECONDS):
+        """
+        take the lock if it is free and the cooldown is over; returns (acquired, reason), the
+        reason being 'modifying' or 'cooldown' if the lock wasn't acquired
+        """
+        now = current_time()
+        return self._update(
+            cluster_identifier,
+            "SET LeaseOwner = :owner, LeaseExpires = :expires",
+            "(attribute_not_exists(LeaseExpires) OR LeaseExpires < :now) "
+            "AND (attribute_not_exists(CooldownUntil) OR CooldownUntil <= :now)",
+            {':owner': {'S': owner}, ':expires': {'N': str(now + lease_seconds)}, ':now': {'N': str(now)}},
+            now
+        )
+
+    def hand_over(self, cluster_identifier, previous_owner, owner, lease_seconds=LOCK_LEASE_SECONDS):
+        """
+        pass the lock from the completed modification to the next one (or take it if it is free);
+        the cooldown doesn't apply here
+        """
+        now = current_time()
+        return self._update(
+            cluster_identifier,
+            "SET LeaseOwner = :owner, LeaseExpires = :expires",
+            "attribute_not_exists(LeaseExpires) OR LeaseExpires < :now OR LeaseOwner = :previous",
+            {':owner': {'S': owner}, ':expires': {'N': str(now + lease_seconds)}, ':now': {'N': str(now)},
+             ':previous': {'S': previous_owner}},
+            now
+        )
+
+    def start_cooldown(self, cluster_identifier, owner, cooldown_seconds=MODIFY_COOLDOWN_PERIOD):
+        """
+        start the cooldown once the modification holding the lock has been started
+        """
+        now = current_time()
+        started, _ = self._update(
+            cluster_identifier,
+            "SET CooldownUntil = :cooldown",
+            "LeaseOwner = :owner",
+            {':owner': {'S': owner}, ':cooldown': {'N': str(now + cooldown_seconds)}},
+            now
+        )
+        return started
+
+    def release(self, cluster_identifier, owner):
+        """
+        release the lock held by the owner
+        """
+        released, _ = self._update(
+            cluster_identifier,
+            "REMOVE LeaseOwner, LeaseExpires",
+            "attribute_not_exists(LeaseOwner) OR LeaseOwner = :owner",
+            {':owner': {'S': owner}},
+            current_time()
+        )
+        return released
+
+    def _update(self, cluster_identifier, update_expression, condition_expression, values, now):
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'ClusterIdentifier': {'S': cluster_identifier}},
+                UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeValues=values,
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+            return True, None
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            item = e.response.get('Item', {})
+            if float(item.get('LeaseExpires', {}).get('N', '0')) >= now:
+                return False, 'modifying'
+            return False, 'cooldown'
+
+
+def current_time():
+    """
+    current time as a unix timestamp
+    """
+    return int(datetime.now(timezone.utc).timestamp())
+
+
+def acquire_scaling_lock(lock_store, cluster_identifier, owner):
+    """
+    take the scaling lock of the cluster before modifying it (replaces the tag and cooldown checks)
+    """
+    acquired, reason = lock_store.acquire(cluster_identifier, owner)
+    if not acquired:
+        if reason == 'cooldown':
+            print("The Cooldown period has not expired for the cluster.")
+        else:
+            print("Another modification holds the scaling lock of the cluster.")
+        record_decision(f"{reason}-skipped", ClusterIdentifier=cluster_identifier)
+    return acquired
+
+
+def mark_modifying(client, lock_store, cluster_identifier, owner, instance_identifier, started,
+                   cooldown_period=MODIFY_COOLDOWN_PERIOD):
+    """
+    tag the instance being modified (if any) or, with the lock store, start the cooldown of the cluster, or
+    release the lock if the modification wasn't started
+    """
+    if lock_store is None:
+        if started and instance_identifier:
+            add_modifying_tag(client, instance_identifier)
+    elif started:
+        lock_store.start_cooldown(cluster_identifier, owner, cooldown_period)
+    else:
+        lock_store.release(cluster_identifier, owner)
+
+
+def start_resize(client, lock_store, cluster_identifier, instance_identifier, new_instance_type,
+                 cooldown_period=MODIFY_COOLDOWN_PERIOD, take_lock=acquire_scaling_lock):
+    """
+    take the scaling lock, change the instance type and mark the instance as being modified;
+    returns (acquired, error)
+    """
+    if lock_store and not take_lock(lock_store, cluster_identifier, owner=instance_identifier):
+        return False, None
+    print(f"Attempting to change the instance type for {instance_identifier} to {new_instance_type}")
+    _, error = change_instance_type(client, instance_identifier, new_instance_type)
+    mark_modifying(client, lock_store, cluster_identifier, instance_identifier, instance_identifier,
+                   not error, cooldown_period)
+    return True, error
+
+
+def start_failover(client, lock_store, cluster_identifier, writer_identifier, reader_identifier,
+                   cooldown_period=MODIFY_COOLDOWN_PERIOD, take_lock=acquire_scaling_lock):
+    """
+    take the scaling lock, fail the cluster over to the reader and mark the old writer as being modified;
+    returns (acquired, error)
+    """
+    if lock_store and not take_lock(lock_store, cluster_identifier, owner=cluster_identifier):
+        return False, None
+    print(f"Attempting to fail over the cluster {cluster_identifier} to {reader_identifier}")
+    _, error = failover_to_reader(client, cluster_identifier, reader_identifier)
+    mark_modifying(client, lock_store, cluster_identifier, cluster_identifier, writer_identifier,
+                   not error, cooldown_period)
+    return True, error
+
+
+def get_lock_store():
+    """
+    get the lock store if LOCK_TABLE is set (otherwise the 'modifying' tags are used)
+    """
+    global _lock_store  # pylint: disable=global-statement
+    if _lock_store is None and LOCK_TABLE:
+        _lock_store = DynamoDBLockStore(get_client('dynamodb'), LOCK_TABLE)
+    return _lock_store
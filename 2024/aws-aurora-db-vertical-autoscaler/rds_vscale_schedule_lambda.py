@@ -0,0 +1,307 @@
+"""
+Lambda function run on a schedule (e.g. an EventBridge rule every 5 minutes)
+to scale clusters up ahead of known traffic peaks and back down afterwards.
+
+The calendar (CAPACITY_CALENDAR, a JSON document or the path to a JSON file)
+lists the windows:
+[{"cluster": "orders", "min_class": "db.r6g.2xlarge", "start": "07:30", "end": "11:00", "days": ["mon", "fri"]},
+ {"cluster": "orders", "min_class": "db.r6g.4xlarge", "start": "2024-11-29T00:00:00+00:00", "end": "2024-12-02T00:00:00+00:00"}]
+Daily windows (in UTC, optionally on some days of the week only) and one-off
+windows are supported. Ahead of a window (SCHEDULE_LEAD_TIME seconds, or
+SCHEDULE_STEP_TIME seconds per member of the cluster if that is longer), the
+instances smaller than its minimum class are scaled up one per invocation,
+readers first; the writer isn't resized in place once the window has started.
+Once no window of the cluster is active, they are
+scaled back to the class they had (the 'scheduledFrom' tag), unless they
+were resized by the alarm since, one per invocation while the cluster isn't
+busy (SCALE_IN_CPU_PERCENT). The 'modifying' tags and the cooldown (or
+the lock store) are respected like in the alarm lambda, and the event lambda
+doesn't propagate the scheduled modifications (the 'scheduled' tag).
+"""
+import json
+import os
+from datetime import datetime, timezone, timedelta
+from rds_vscale_core import (
+    get_client, send_sns_alert, instance_type_sorter, any_member_modifying, any_instance_has_modifying_tag,
+    modification_timestamps, instrumented, cluster_is_busy,
+    record_decision, get_cluster_config, map_concurrently, cluster_metrics, read_json_setting
+)
+from rds_vscale_lock import get_lock_store, start_resize, start_failover
+
+CAPACITY_CALENDAR = os.environ.get("CAPACITY_CALENDAR", "[]")
+SCHEDULE_LEAD_TIME = int(os.environ.get("SCHEDULE_LEAD_TIME", "3600"))
+# The time to allow for each member: its resize or the cooldown, whichever is longer, and the schedule interval
+SCHEDULE_STEP_TIME = int(os.environ.get("SCHEDULE_STEP_TIME", "1200"))
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+_calendar = None
+
+
+def load_capacity_calendar():
+    """
+    load the capacity calendar (once per container)
+    """
+    global _calendar  # pylint: disable=global-statement
+    if _calendar is None:
+        _calendar = read_json_setting(CAPACITY_CALENDAR)
+    return _calendar
+
+
+def parse_moment(value):
+    """
+    parse a date and time of a one-off window (UTC unless the offset is given)
+    """
+    moment = datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def window_occurrences(entry, now):
+    """
+    (start, end) of the occurrences of the window around now
+    """
+    if 'T' in entry['start']:
+        return [(parse_moment(entry['start']), parse_moment(entry['end']))]
+    start_time = datetime.strptime(entry['start'], '%H:%M').time()
+    end_time = datetime.strptime(entry['end'], '%H:%M').time()
+    days = [day.lower()[:3] for day in entry.get('days', WEEKDAYS)]
+    occurrences = []
+    for offset in (-1, 0, 1):
+        day = (now + timedelta(days=offset)).date()
+        if WEEKDAYS[day.weekday()] not in days:
+            continue
+        start = datetime.combine(day, start_time, tzinfo=timezone.utc)
+        end = datetime.combine(day, end_time, tzinfo=timezone.utc)
+        if end <= start:
+            # The window goes past midnight
+            end += timedelta(days=1)
+        occurrences.append((start, end))
+    return occurrences
+
+
+def schedule_lead_time(member_count, cooldown_period):
+    """
+    how long before a window the cluster starts to be scaled up
+    """
+    return max(SCHEDULE_LEAD_TIME, member_count * max(SCHEDULE_STEP_TIME, cooldown_period))
+
+
+def required_class(calendar, cluster_identifier, now, lead_time, size_order=None):
+    """
+    the minimum class of the cluster right now (None if no window is active) and whether a window has started
+    """
+    required, started = None, False
+    for entry in calendar:
+        if entry['cluster'] != cluster_identifier:
+            continue
+        occurrences = window_occurrences(entry, now)
+        if not any(start - timedelta(seconds=lead_time) <= now < end for start, end in occurrences):
+            continue
+        started = started or any(start <= now < end for start, end in occurrences)
+        if required is None or instance_type_sorter(entry['min_class'], size_order) > instance_type_sorter(required, size_order):
+            required = entry['min_class']
+    return required, started
+
+
+@instrumented("schedule")
+def lambda_handler(event, _):
+    """
+    lambda function triggered by schedule
+    """
+    print("Received event: " + json.dumps(event, indent=2))
+    rds_client = get_client('rds')
+    lock_store = get_lock_store()
+    calendar = load_capacity_calendar()
+    now = datetime.now(timezone.utc)
+    clusters = list(dict.fromkeys(entry['cluster'] for entry in calendar))
+
+    failures = []
+
+    def process_cluster(cluster_identifier):
+        cluster_config = get_cluster_config(cluster_identifier)
+        with cluster_metrics(cluster_identifier, len(clusters) > 1):
+            if cluster_config is None:
+                print(f"Ignoring the calendar of cluster: {cluster_identifier}")
+                record_decision("ignored", ClusterIdentifier=cluster_identifier)
+                return
+            try:
+                process_schedule(rds_client, lock_store, cluster_identifier, calendar, now, cluster_config)
+            except Exception as e:  # pylint: disable=broad-except
+                error_message = f"Failed to apply the capacity calendar to cluster {cluster_identifier}. Error: {e}"
+                print(error_message)
+                send_sns_alert(error_message)
+                record_decision("failed", ClusterIdentifier=cluster_identifier)
+                failures.append(e)
+
+    map_concurrently(process_cluster, clusters)
+    # Raised once every cluster is processed, whatever the number of clusters in the calendar
+    if failures:
+        raise failures[0]
+    return {
+        'statusCode': 200,
+        'body': json.dumps("Processed the capacity calendar.")
+    }
+
+
+def process_schedule(rds_client, lock_store, cluster_identifier, calendar, now, cluster_config):
+    """
+    scale one instance of the cluster up to the minimum class of the active window or back after it
+    """
+    cluster_response = rds_client.describe_db_clusters(DBClusterIdentifier=cluster_identifier)
+    cluster_info = cluster_response['DBClusters'][0]
+    cluster_members = cluster_info['DBClusterMembers']
+    lead_time = schedule_lead_time(len(cluster_members), cluster_config['cooldown'])
+    min_class, started = required_class(calendar, cluster_identifier, now, lead_time, cluster_config['size_order'])
+
+    if any_member_modifying(rds_client, cluster_members) or cluster_info['Status'] != 'available':
+        print("At least one instance in the cluster is currently being modified.")
+        record_decision("modifying-skipped", ClusterIdentifier=cluster_identifier)
+        return
+    if lock_store is None and any_instance_has_modifying_tag(rds_client, cluster_members):
+        print("An instance in the cluster has the 'modifying' tag.")
+        record_decision("modifying-skipped", ClusterIdentifier=cluster_identifier)
+        return
+    if lock_store is None and modification_timestamps(rds_client, cluster_members, cluster_config['cooldown']):
+        print("The Cooldown period has not expired for at least one instance in the cluster.")
+        record_decision("cooldown-skipped", ClusterIdentifier=cluster_identifier)
+        return
+
+    instances = describe_members(rds_client, cluster_members)
+    if min_class:
+        scale_up_for_window(rds_client, lock_store, cluster_info, instances, min_class, started, cluster_config)
+    else:
+        release_after_window(rds_client, lock_store, cluster_info, instances, cluster_config)
+
+
+def describe_members(client, cluster_members):
+    """
+    the instances of the cluster with their writer flag and tags
+    """
+    instances = []
+    for member in cluster_members:
+        instance = client.describe_db_instances(DBInstanceIdentifier=member['DBInstanceIdentifier'])['DBInstances'][0]
+        tags = client.list_tags_for_resource(ResourceName=instance['DBInstanceArn'])['TagList']
+        instance['IsClusterWriter'] = member['IsClusterWriter']
+        instance['Tags'] = {tag['Key']: tag['Value'] for tag in tags}
+        instances.append(instance)
+    return instances
+
+
+def scale_up_for_window(client, lock_store, cluster_info, instances, min_class, started, cluster_config):
+    """
+    scale the smallest instance below the minimum class up to it, the readers before the writer
+    """
+    cluster_identifier = cluster_info['DBClusterIdentifier']
+    size_order = cluster_config['size_order']
+    below = [instance for instance in instances
+             if instance_type_sorter(instance['DBInstanceClass'], size_order) < instance_type_sorter(min_class, size_order)]
+    if not below:
+        print(f"All instances of the cluster are of the class {min_class} or bigger.")
+        record_decision("no-action", min_class, min_class, ClusterIdentifier=cluster_identifier)
+        return
+    below.sort(key=lambda instance: (instance['IsClusterWriter'], instance_type_sorter(instance['DBInstanceClass'], size_order)))
+    instance = below[0]
+    tags = {'scheduled': 'true', 'scheduledClass': min_class}
+    if 'scheduledFrom' not in instance['Tags']:
+        tags['scheduledFrom'] = instance['DBInstanceClass']
+
+    if instance['IsClusterWriter'] and cluster_config['writer_scale_strategy'] == "failover":
+        targets = [reader for reader in instances if not reader['IsClusterWriter']
+                   and instance_type_sorter(reader['DBInstanceClass'], size_order) >= instance_type_sorter(min_class, size_order)]
+        if targets:
+            # The old writer is scaled up as a reader by a later invocation
+            target = min(targets, key=lambda reader: instance_type_sorter(reader['DBInstanceClass'], size_order))
+            fail_over(client, lock_store, cluster_info, instance, target, "writer-up", cluster_config)
+            return
+    if instance['IsClusterWriter'] and started:
+        # Resizing the writer in place stops the writes for minutes, not in the middle of the peak
+        print(f"The window has started, not resizing the writer {instance['DBInstanceIdentifier']} in place.")
+        record_decision("window-skipped", instance['DBInstanceClass'], min_class, ClusterIdentifier=cluster_identifier,
+                        InstanceIdentifier=instance['DBInstanceIdentifier'])
+        return
+    modify(client, lock_store, cluster_identifier, instance, min_class, tags, [], cluster_config)
+
+
+def release_after_window(client, lock_store, cluster_info, instances, cluster_config):
+    """
+    scale an instance scaled up for a window back to its class, the readers before the writer
+    """
+    cluster_identifier = cluster_info['DBClusterIdentifier']
+    scheduled = []
+    for instance in instances:
+        if 'scheduledFrom' not in instance['Tags']:
+            continue
+        if instance['DBInstanceClass'] != instance['Tags'].get('scheduledClass'):
+            # Resized by the alarm since: the capacity is needed, keep it
+            print(f"Instance {instance['DBInstanceIdentifier']} was resized since the window, keeping its class.")
+            client.remove_tags_from_resource(ResourceName=instance['DBInstanceArn'], TagKeys=['scheduledFrom', 'scheduledClass'])
+            continue
+        scheduled.append(instance)
+    if not scheduled:
+        print("No instances to scale back after the windows.")
+        record_decision("no-action", ClusterIdentifier=cluster_identifier)
+        return
+    if cluster_is_busy([instance['DBInstanceIdentifier'] for instance in instances]):
+        # The alarm doesn't notify again while it stays in the ALARM state, don't take the capacity away under load
+        print("The cluster is busy, not scaling it back yet.")
+        record_decision("load-skipped", ClusterIdentifier=cluster_identifier)
+        return
+    scheduled.sort(key=lambda instance: instance['IsClusterWriter'])
+    instance = scheduled[0]
+    original_class = instance['Tags']['scheduledFrom']
+
+    if instance['IsClusterWriter'] and cluster_config['writer_scale_strategy'] == "failover":
+        targets = [reader for reader in instances if not reader['IsClusterWriter'] and reader['DBInstanceClass'] == original_class]
+        if targets:
+            # The old writer is scaled back as a reader by a later invocation
+            fail_over(client, lock_store, cluster_info, instance, targets[0], "writer-down", cluster_config)
+            return
+    modify(client, lock_store, cluster_identifier, instance, original_class, {'scheduled': 'true'},
+           ['scheduledFrom', 'scheduledClass'], cluster_config)
+
+
+def modify(client, lock_store, cluster_identifier, instance, new_instance_type, tags, removed_tags, cluster_config):
+    """
+    change the instance type, tagging the instance as being modified by the schedule
+    """
+    instance_identifier = instance['DBInstanceIdentifier']
+    acquired, error = start_resize(client, lock_store, cluster_identifier, instance_identifier, new_instance_type,
+                                   cluster_config['cooldown'])
+    if not acquired:
+        return
+    role = "writer" if instance['IsClusterWriter'] else "reader"
+    direction = "up" if instance_type_sorter(new_instance_type, cluster_config['size_order']) > \
+        instance_type_sorter(instance['DBInstanceClass'], cluster_config['size_order']) else "down"
+    if error:
+        record_decision("failed", instance['DBInstanceClass'], new_instance_type,
+                        ClusterIdentifier=cluster_identifier, InstanceIdentifier=instance_identifier)
+        return
+    client.add_tags_to_resource(ResourceName=instance['DBInstanceArn'],
+                                Tags=[{'Key': key, 'Value': value} for key, value in tags.items()])
+    if removed_tags:
+        client.remove_tags_from_resource(ResourceName=instance['DBInstanceArn'], TagKeys=removed_tags)
+    message = f"Changed the {role} instance type to {new_instance_type} as scheduled"
+    print(message)
+    send_sns_alert(message)
+    record_decision(f"{role}-{direction}", instance['DBInstanceClass'], new_instance_type,
+                    ClusterIdentifier=cluster_identifier, InstanceIdentifier=instance_identifier, Strategy="modify")
+
+
+def fail_over(client, lock_store, cluster_info, writer, target, action, cluster_config):
+    """
+    promote the reader, tagging the cluster as being failed over by the schedule
+    """
+    cluster_identifier = cluster_info['DBClusterIdentifier']
+    acquired, error = start_failover(client, lock_store, cluster_identifier, writer['DBInstanceIdentifier'],
+                                     target['DBInstanceIdentifier'], cluster_config['cooldown'])
+    if not acquired:
+        return
+    if error:
+        record_decision("failed", writer['DBInstanceClass'], target['DBInstanceClass'],
+                        ClusterIdentifier=cluster_identifier, InstanceIdentifier=target['DBInstanceIdentifier'])
+        return
+    client.add_tags_to_resource(ResourceName=cluster_info['DBClusterArn'], Tags=[{'Key': 'scheduled', 'Value': 'true'}])
+    message = f"Failed over the writer role from {writer['DBInstanceIdentifier']} to {target['DBInstanceIdentifier']} as scheduled"
+    print(message)
+    send_sns_alert(message)
+    record_decision(action, writer['DBInstanceClass'], target['DBInstanceClass'], ClusterIdentifier=cluster_identifier,
+                    InstanceIdentifier=target['DBInstanceIdentifier'], Strategy="failover")
@@ -0,0 +1,625 @@
+"""
+In-process fake of the RDS, SNS, CloudWatch and DynamoDB APIs used by the autoscaler lambdas.
+
+It models the cluster members, their statuses and tags, and the time
+modifications and failovers take, so the lambdas can be run offline
+(see rds_vscale_bench.py).
+"""
+import contextvars
+import copy
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timezone, timedelta
+from botocore.exceptions import ClientError
+
+
+EVENT_ID_PREFIX = 'http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/USER_Events.Messages.html#'
+MODIFYING_STATUSES = ["modifying", "storage-optimization", "creating", "rebooting", "deleting"]
+
+# name of the invocation making the calls; a context variable, so the threads started by an invocation inherit it
+current_invocation = contextvars.ContextVar('current_invocation', default=None)
+
+
+class SimClock:
+    """
+    virtual clock shared by the backend and the lambdas
+    """
+    def __init__(self, start=None):
+        self.current = start or datetime(2024, 4, 1, tzinfo=timezone.utc)
+        self.start = self.current
+
+    def now(self):
+        return self.current
+
+    def elapsed(self):
+        return (self.current - self.start).total_seconds()
+
+    def advance_to(self, moment):
+        if moment > self.current:
+            self.current = moment
+
+    def datetime_class(self):
+        """
+        datetime replacement whose now() follows the virtual clock
+        """
+        clock = self
+
+        class SimDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                current = clock.now()
+                return current.astimezone(tz) if tz else current.replace(tzinfo=None)
+
+        return SimDatetime
+
+
+class Turnstile:
+    """
+    lets concurrent invocations make their API calls in a strict round-robin order,
+    so races between them are reproducible
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.order = []
+        self.turn = 0
+
+    def join(self, name):
+        with self.condition:
+            self.order.append(name)
+
+    def leave(self, name):
+        with self.condition:
+            index = self.order.index(name)
+            self.order.pop(index)
+            if index < self.turn:
+                self.turn -= 1
+            if self.order:
+                self.turn %= len(self.order)
+            self.condition.notify_all()
+
+    def wait(self, name):
+        with self.condition:
+            self.condition.wait_for(lambda: name not in self.order or self.order[self.turn] == name)
+
+    def passed(self, name):
+        with self.condition:
+            if name in self.order:
+                self.turn = (self.order.index(name) + 1) % len(self.order)
+            self.condition.notify_all()
+
+
+def client_error(code, message, operation):
+    """
+    build a botocore error the same way a real client raises it
+    """
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class FakeBackend:
+    """
+    state of the simulated clusters and the record of every API call made against it
+    """
+    def __init__(self, clock=None, modify_duration=600, failover_duration=30,
+                 create_duration=900, delete_duration=300, region='eu-central-1', account='123456789012'):
+        self.clock = clock or SimClock()
+        self.modify_duration = modify_duration
+        self.failover_duration = failover_duration
+        self.create_duration = create_duration
+        self.delete_duration = delete_duration
+        self.region = region
+        self.account = account
+        self.lock = threading.RLock()
+        self.turnstile = None
+        self.clusters = {}
+        self.instances = {}
+        self.pending = []
+        self.events = []
+        self.calls = []
+        self.messages = []
+        self.metrics = {}
+        self.tables = {}
+        self.violations = []
+        self.write_downtime = 0.0
+
+    # --- setup
+
+    def add_cluster(self, cluster_identifier, writer_class, reader_classes, engine='aurora-postgresql',
+                    engine_version='15.4', tags=None, instance_tags=None):
+        """
+        create an available cluster with a writer and readers of the given classes
+        """
+        cluster_tags = {'Cluster': cluster_identifier}
+        cluster_tags.update(tags or {})
+        self.clusters[cluster_identifier] = {
+            'DBClusterIdentifier': cluster_identifier,
+            'DBClusterArn': self.arn('cluster', cluster_identifier),
+            'Status': 'available',
+            'Engine': engine,
+            'EngineVersion': engine_version,
+            'Members': [],
+            'Tags': cluster_tags,
+        }
+        self.add_instance(cluster_identifier, f"{cluster_identifier}-instance-1", writer_class, writer=True,
+                          tags=instance_tags)
+        for number, reader_class in enumerate(reader_classes, start=2):
+            self.add_instance(cluster_identifier, f"{cluster_identifier}-instance-{number}", reader_class,
+                              tags=instance_tags)
+
+    def add_instance(self, cluster_identifier, instance_identifier, instance_class, writer=False,
+                     status='available', tags=None):
+        cluster = self.clusters[cluster_identifier]
+        instance_tags = {'Cluster': cluster_identifier}
+        instance_tags.update(tags or {})
+        self.instances[instance_identifier] = {
+            'DBInstanceIdentifier': instance_identifier,
+            'DBInstanceArn': self.arn('db', instance_identifier),
+            'DBInstanceClass': instance_class,
+            'DBInstanceStatus': status,
+            'DBClusterIdentifier': cluster_identifier,
+            'Engine': cluster['Engine'],
+            'Tags': instance_tags,
+        }
+        cluster['Members'].append({'DBInstanceIdentifier': instance_identifier, 'IsClusterWriter': writer})
+
+    def set_metric(self, instance_identifier, metric_name, value):
+        self.metrics[(instance_identifier, metric_name)] = value
+
+    def arn(self, kind, identifier):
+        return f"arn:aws:rds:{self.region}:{self.account}:{kind}:{identifier}"
+
+    # --- API call bookkeeping
+
+    def begin(self, invocation):
+        current_invocation.set(invocation)
+
+    def record(self, service, operation):
+        """
+        register an API call of the current invocation (and wait for its turn if invocations interleave)
+        """
+        invocation = current_invocation.get()
+        if self.turnstile and invocation is not None:
+            self.turnstile.wait(invocation)
+        with self.lock:
+            self.calls.append((invocation, service, operation))
+
+    def yielded(self):
+        invocation = current_invocation.get()
+        if self.turnstile and invocation is not None:
+            self.turnstile.passed(invocation)
+
+    def calls_of(self, invocation):
+        return Counter(f"{service}.{operation}" for inv, service, operation in self.calls if inv == invocation)
+
+    # --- lookups
+
+    def find_instance(self, instance_identifier, operation):
+        if instance_identifier not in self.instances:
+            raise client_error('DBInstanceNotFound', f"DBInstance {instance_identifier} not found.", operation)
+        return self.instances[instance_identifier]
+
+    def find_cluster(self, cluster_identifier, operation):
+        if cluster_identifier not in self.clusters:
+            raise client_error('DBClusterNotFoundFault', f"DBCluster {cluster_identifier} not found.", operation)
+        return self.clusters[cluster_identifier]
+
+    def find_resource(self, arn, operation):
+        for resource in list(self.instances.values()):
+            if resource['DBInstanceArn'] == arn:
+                return resource
+        for resource in self.clusters.values():
+            if resource['DBClusterArn'] == arn:
+                return resource
+        raise client_error('DBInstanceNotFound', f"Resource {arn} not found.", operation)
+
+    def writer_of(self, cluster_identifier):
+        for member in self.clusters[cluster_identifier]['Members']:
+            if member['IsClusterWriter']:
+                return member['DBInstanceIdentifier']
+        return None
+
+    def busy_members(self, cluster_identifier):
+        return [member['DBInstanceIdentifier'] for member in self.clusters[cluster_identifier]['Members']
+                if self.instances[member['DBInstanceIdentifier']]['DBInstanceStatus'] in MODIFYING_STATUSES]
+
+    # --- transitions
+
+    def schedule(self, seconds, action, *args):
+        self.pending.append((self.clock.now() + timedelta(seconds=seconds), action, args))
+        self.pending.sort(key=lambda item: item[0])
+
+    def next_transition(self):
+        return self.pending[0][0] if self.pending else None
+
+    def run_until(self, moment):
+        """
+        complete every transition due by the moment; returns the RDS events they emitted
+        """
+        emitted = []
+        while self.pending and self.pending[0][0] <= moment:
+            due, action, args = self.pending.pop(0)
+            self.clock.advance_to(due)
+            event = action(*args)
+            if event:
+                emitted.append(event)
+        self.clock.advance_to(moment)
+        return emitted
+
+    def instance_event(self, instance, event_number, message):
+        event = {
+            'Event Source': 'db-instance',
+            'Event Time': self.clock.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+            'Identifier Link': '',
+            'Source ID': instance['DBInstanceIdentifier'],
+            'Source ARN': instance['DBInstanceArn'],
+            'Event ID': EVENT_ID_PREFIX + event_number,
+            'Event Message': message,
+            'Tags': dict(instance['Tags']),
+        }
+        self.events.append(event)
+        return event
+
+    def cluster_event(self, cluster, event_number, message):
+        event = {
+            'Event Source': 'db-cluster',
+            'Event Time': self.clock.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+            'Identifier Link': '',
+            'Source ID': cluster['DBClusterIdentifier'],
+            'Source ARN': cluster['DBClusterArn'],
+            'Event ID': EVENT_ID_PREFIX + event_number,
+            'Event Message': message,
+            'Tags': dict(cluster['Tags']),
+        }
+        self.events.append(event)
+        return event
+
+    def finish_modification(self, instance_identifier, instance_class):
+        instance = self.instances[instance_identifier]
+        instance['DBInstanceClass'] = instance_class
+        instance['DBInstanceStatus'] = 'available'
+        return self.instance_event(instance, 'RDS-EVENT-0014', 'The DB instance class for this DB instance has changed.')
+
+    def finish_failover(self, cluster_identifier, target_identifier):
+        cluster = self.clusters[cluster_identifier]
+        for member in cluster['Members']:
+            member['IsClusterWriter'] = member['DBInstanceIdentifier'] == target_identifier
+        cluster['Status'] = 'available'
+        return self.cluster_event(cluster, 'RDS-EVENT-0071', f"Completed failover to DB instance: {target_identifier}")
+
+    def finish_creation(self, instance_identifier):
+        instance = self.instances[instance_identifier]
+        instance['DBInstanceStatus'] = 'available'
+        return self.instance_event(instance, 'RDS-EVENT-0005', 'DB instance created')
+
+    def finish_deletion(self, instance_identifier):
+        instance = self.instances.pop(instance_identifier)
+        cluster = self.clusters[instance['DBClusterIdentifier']]
+        cluster['Members'] = [member for member in cluster['Members'] if member['DBInstanceIdentifier'] != instance_identifier]
+        return self.instance_event(instance, 'RDS-EVENT-0003', 'DB instance deleted')
+
+    def check_concurrency(self, cluster_identifier, instance_identifier):
+        others = [member for member in self.busy_members(cluster_identifier) if member != instance_identifier]
+        if others:
+            self.violations.append(
+                f"{self.clock.elapsed():.0f}s: {instance_identifier} modified while {', '.join(others)} "
+                f"{'is' if len(others) == 1 else 'are'} being modified"
+            )
+
+
+class FakeClient:
+    """
+    common part of the fake service clients
+    """
+    service = None
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def call(self, operation, handler):
+        self.backend.record(self.service, operation)
+        try:
+            with self.backend.lock:
+                return copy.deepcopy(handler())
+        finally:
+            self.backend.yielded()
+
+
+class FakeRDSClient(FakeClient):
+    """
+    fake boto3 rds client
+    """
+    service = 'rds'
+
+    def describe_db_instances(self, DBInstanceIdentifier=None, Filters=None):
+        def handler():
+            backend = self.backend
+            if DBInstanceIdentifier:
+                instances = [backend.find_instance(DBInstanceIdentifier, 'DescribeDBInstances')]
+            else:
+                instances = list(backend.instances.values())
+            for instance_filter in Filters or []:
+                if instance_filter['Name'] in ('db-cluster-id', 'db-cluster-identifier'):
+                    instances = [i for i in instances if i['DBClusterIdentifier'] in instance_filter['Values']]
+                elif instance_filter['Name'] in ('db-instance-id', 'db-instance-identifier'):
+                    instances = [i for i in instances if i['DBInstanceIdentifier'] in instance_filter['Values']]
+            return {'DBInstances': [{k: v for k, v in i.items() if k != 'Tags'} for i in instances]}
+        return self.call('DescribeDBInstances', handler)
+
+    def describe_db_clusters(self, DBClusterIdentifier=None):
+        def handler():
+            backend = self.backend
+            if DBClusterIdentifier:
+                clusters = [backend.find_cluster(DBClusterIdentifier, 'DescribeDBClusters')]
+            else:
+                clusters = list(backend.clusters.values())
+            described = []
+            for cluster in clusters:
+                described.append({
+                    'DBClusterIdentifier': cluster['DBClusterIdentifier'],
+                    'DBClusterArn': cluster['DBClusterArn'],
+                    'Status': cluster['Status'],
+                    'Engine': cluster['Engine'],
+                    'EngineVersion': cluster['EngineVersion'],
+                    'DBClusterMembers': cluster['Members'],
+                })
+            return {'DBClusters': described}
+        return self.call('DescribeDBClusters', handler)
+
+    def modify_db_instance(self, DBInstanceIdentifier, DBInstanceClass=None, ApplyImmediately=False):
+        def handler():
+            backend = self.backend
+            instance = backend.find_instance(DBInstanceIdentifier, 'ModifyDBInstance')
+            if instance['DBInstanceStatus'] != 'available':
+                backend.violations.append(
+                    f"{backend.clock.elapsed():.0f}s: {DBInstanceIdentifier} modified in the "
+                    f"'{instance['DBInstanceStatus']}' status"
+                )
+                raise client_error('InvalidDBInstanceState', f"Instance {DBInstanceIdentifier} is not available.", 'ModifyDBInstance')
+            backend.check_concurrency(instance['DBClusterIdentifier'], DBInstanceIdentifier)
+            instance['DBInstanceStatus'] = 'modifying'
+            if backend.writer_of(instance['DBClusterIdentifier']) == DBInstanceIdentifier:
+                backend.write_downtime += backend.modify_duration
+            backend.schedule(backend.modify_duration, backend.finish_modification, DBInstanceIdentifier, DBInstanceClass)
+            return {'DBInstance': {k: v for k, v in instance.items() if k != 'Tags'}}
+        return self.call('ModifyDBInstance', handler)
+
+    def failover_db_cluster(self, DBClusterIdentifier, TargetDBInstanceIdentifier=None):
+        def handler():
+            backend = self.backend
+            cluster = backend.find_cluster(DBClusterIdentifier, 'FailoverDBCluster')
+            if cluster['Status'] != 'available':
+                raise client_error('InvalidDBClusterStateFault', f"Cluster {DBClusterIdentifier} is not available.", 'FailoverDBCluster')
+            target = backend.find_instance(TargetDBInstanceIdentifier, 'FailoverDBCluster')
+            if target['DBInstanceStatus'] != 'available':
+                raise client_error('InvalidDBInstanceState', f"Instance {TargetDBInstanceIdentifier} is not available.", 'FailoverDBCluster')
+            backend.check_concurrency(DBClusterIdentifier, None)
+            cluster['Status'] = 'failing-over'
+            backend.write_downtime += backend.failover_duration
+            backend.schedule(backend.failover_duration, backend.finish_failover, DBClusterIdentifier, TargetDBInstanceIdentifier)
+            return {'DBCluster': {'DBClusterIdentifier': DBClusterIdentifier, 'Status': cluster['Status']}}
+        return self.call('FailoverDBCluster', handler)
+
+    def create_db_instance(self, DBInstanceIdentifier, DBInstanceClass, Engine, DBClusterIdentifier, Tags=None, **_):
+        def handler():
+            backend = self.backend
+            cluster = backend.find_cluster(DBClusterIdentifier, 'CreateDBInstance')
+            if DBInstanceIdentifier in backend.instances:
+                raise client_error('DBInstanceAlreadyExists', f"DBInstance {DBInstanceIdentifier} already exists.", 'CreateDBInstance')
+            backend.check_concurrency(DBClusterIdentifier, None)
+            backend.add_instance(DBClusterIdentifier, DBInstanceIdentifier, DBInstanceClass, status='creating',
+                                 tags={tag['Key']: tag['Value'] for tag in Tags or []})
+            backend.instances[DBInstanceIdentifier]['Engine'] = Engine or cluster['Engine']
+            backend.schedule(backend.create_duration, backend.finish_creation, DBInstanceIdentifier)
+            return {'DBInstance': {k: v for k, v in backend.instances[DBInstanceIdentifier].items() if k != 'Tags'}}
+        return self.call('CreateDBInstance', handler)
+
+    def delete_db_instance(self, DBInstanceIdentifier, **_):
+        def handler():
+            backend = self.backend
+            instance = backend.find_instance(DBInstanceIdentifier, 'DeleteDBInstance')
+            if instance['DBInstanceStatus'] != 'available':
+                raise client_error('InvalidDBInstanceState', f"Instance {DBInstanceIdentifier} is not available.", 'DeleteDBInstance')
+            if backend.writer_of(instance['DBClusterIdentifier']) == DBInstanceIdentifier:
+                backend.violations.append(f"{backend.clock.elapsed():.0f}s: the writer {DBInstanceIdentifier} was deleted")
+            backend.check_concurrency(instance['DBClusterIdentifier'], DBInstanceIdentifier)
+            instance['DBInstanceStatus'] = 'deleting'
+            backend.schedule(backend.delete_duration, backend.finish_deletion, DBInstanceIdentifier)
+            return {'DBInstance': {k: v for k, v in instance.items() if k != 'Tags'}}
+        return self.call('DeleteDBInstance', handler)
+
+    def add_tags_to_resource(self, ResourceName, Tags):
+        def handler():
+            resource = self.backend.find_resource(ResourceName, 'AddTagsToResource')
+            for tag in Tags:
+                resource['Tags'][tag['Key']] = tag['Value']
+            return {}
+        return self.call('AddTagsToResource', handler)
+
+    def list_tags_for_resource(self, ResourceName):
+        def handler():
+            resource = self.backend.find_resource(ResourceName, 'ListTagsForResource')
+            return {'TagList': [{'Key': key, 'Value': value} for key, value in resource['Tags'].items()]}
+        return self.call('ListTagsForResource', handler)
+
+    def remove_tags_from_resource(self, ResourceName, TagKeys):
+        def handler():
+            resource = self.backend.find_resource(ResourceName, 'RemoveTagsFromResource')
+            for key in TagKeys:
+                resource['Tags'].pop(key, None)
+            return {}
+        return self.call('RemoveTagsFromResource', handler)
+
+
+class FakeSNSClient(FakeClient):
+    """
+    fake boto3 sns client
+    """
+    service = 'sns'
+
+    def publish(self, TopicArn, Message, **_):
+        def handler():
+            self.backend.messages.append((TopicArn, Message))
+            return {'MessageId': str(len(self.backend.messages))}
+        return self.call('Publish', handler)
+
+
+class FakeCloudWatchClient(FakeClient):
+    """
+    fake boto3 cloudwatch client; metric values are constant and set with FakeBackend.set_metric
+    """
+    service = 'cloudwatch'
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, **_):
+        def handler():
+            results = []
+            for query in MetricDataQueries:
+                metric = query['MetricStat']['Metric']
+                dimensions = {d['Name']: d['Value'] for d in metric.get('Dimensions', [])}
+                key = (dimensions.get('DBInstanceIdentifier'), metric['MetricName'])
+                value = self.backend.metrics.get(key)
+                results.append({
+                    'Id': query['Id'],
+                    'Label': metric['MetricName'],
+                    'Timestamps': [EndTime] if value is not None else [],
+                    'Values': [value] if value is not None else [],
+                    'StatusCode': 'Complete',
+                })
+            return {'MetricDataResults': results, 'Messages': []}
+        return self.call('GetMetricData', handler)
+
+
+class Expression:
+    """
+    evaluator of the subset of DynamoDB condition and update expressions used by the lock store:
+    AND/OR/parentheses, comparisons, attribute_exists/attribute_not_exists, SET and REMOVE
+    """
+    TOKEN = re.compile(r"\s*(<=|>=|<>|[()=<>,]|:\w+|#\w+|\w+)")
+
+    def __init__(self, text, values, names=None):
+        self.tokens = self.TOKEN.findall(text)
+        self.position = 0
+        self.values = values or {}
+        self.names = names or {}
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected and (token or '').upper() != expected:
+            raise ValueError(f"expected {expected}, got {token}")
+        self.position += 1
+        return token
+
+    def name(self):
+        token = self.take()
+        return self.names.get(token, token)
+
+    def value(self, item):
+        token = self.take()
+        if token.startswith(':'):
+            typed = self.values[token]
+        else:
+            typed = item.get(self.names.get(token, token))
+        if typed is None:
+            return None
+        if 'N' in typed:
+            return float(typed['N'])
+        return typed.get('S')
+
+    def condition(self, item):
+        result = self.conjunction(item)
+        while (self.peek() or '').upper() == 'OR':
+            self.take()
+            right = self.conjunction(item)
+            result = result or right
+        return result
+
+    def conjunction(self, item):
+        result = self.factor(item)
+        while (self.peek() or '').upper() == 'AND':
+            self.take()
+            right = self.factor(item)
+            result = result and right
+        return result
+
+    def factor(self, item):
+        token = self.peek()
+        if token == '(':
+            self.take()
+            result = self.condition(item)
+            self.take(')')
+            return result
+        if token in ('attribute_exists', 'attribute_not_exists'):
+            self.take()
+            self.take('(')
+            exists = self.name() in item
+            self.take(')')
+            return exists if token == 'attribute_exists' else not exists
+        left = self.value(item)
+        operator = self.take()
+        right = self.value(item)
+        if left is None or right is None:
+            return operator == '<>' and left != right
+        comparisons = {
+            '=': lambda a, b: a == b, '<>': lambda a, b: a != b, '<': lambda a, b: a < b,
+            '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+        }
+        return comparisons[operator](left, right)
+
+    def update(self, item):
+        while self.peek():
+            clause = self.take().upper()
+            while True:
+                attribute = self.name()
+                if clause == 'SET':
+                    self.take('=')
+                    item[attribute] = copy.deepcopy(self.values[self.take()])
+                elif clause == 'REMOVE':
+                    item.pop(attribute, None)
+                else:
+                    raise ValueError(f"unsupported clause {clause}")
+                if self.peek() != ',':
+                    break
+                self.take()
+
+
+class FakeDynamoDBClient(FakeClient):
+    """
+    fake boto3 dynamodb client (tables are created on first use, items are keyed by their key attribute values)
+    """
+    service = 'dynamodb'
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None,
+                    ExpressionAttributeValues=None, ExpressionAttributeNames=None,
+                    ReturnValuesOnConditionCheckFailure=None, **_):
+        def handler():
+            table = self.backend.tables.setdefault(TableName, {})
+            key = tuple(sorted((name, next(iter(value.values()))) for name, value in Key.items()))
+            item = table.get(key, dict(Key))
+            if ConditionExpression and not Expression(
+                    ConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames).condition(item):
+                error = client_error('ConditionalCheckFailedException', 'The conditional request failed', 'UpdateItem')
+                if ReturnValuesOnConditionCheckFailure == 'ALL_OLD' and key in table:
+                    error.response['Item'] = copy.deepcopy(table[key])
+                raise error
+            Expression(UpdateExpression, ExpressionAttributeValues, ExpressionAttributeNames).update(item)
+            table[key] = item
+            return {}
+        return self.call('UpdateItem', handler)
+
+    def get_item(self, TableName, Key, **_):
+        def handler():
+            table = self.backend.tables.setdefault(TableName, {})
+            key = tuple(sorted((name, next(iter(value.values()))) for name, value in Key.items()))
+            return {'Item': table[key]} if key in table else {}
+        return self.call('GetItem', handler)
+
+
+def make_client(backend, service_name):
+    """
+    boto3.client() replacement
+    """
+    clients = {'rds': FakeRDSClient, 'sns': FakeSNSClient, 'cloudwatch': FakeCloudWatchClient,
+               'dynamodb': FakeDynamoDBClient}
+    return clients[service_name](backend)